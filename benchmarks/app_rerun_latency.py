@@ -0,0 +1,41 @@
+"""
+app_rerun_latency.py
+
+Description:
+    Measures how long the Streamlit app takes to execute on its first run (start-up, when the cached resources are
+    built) and on the reruns that follow every user interaction, using Streamlit's AppTest harness.
+
+    Requires a built knowledge base (data_store, entities.db, vector_index.bin). No question is asked, so no LLM
+    calls are made.
+
+Usage:
+    python -m benchmarks.app_rerun_latency [reruns]
+"""
+import os
+import sys
+import time
+
+from streamlit.testing.v1 import AppTest
+
+
+def main(reruns=10):
+    # The Bedrock client needs a region to be constructed even though it is not called
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    app = AppTest.from_file("chatizard.py", default_timeout=300)
+    start = time.perf_counter()
+    app.run()
+    print(f"start-up run: {(time.perf_counter() - start) * 1000:9.2f} ms")
+
+    timings = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        app.run()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f"reruns={reruns}  mean={sum(timings) / len(timings) * 1000:9.2f} ms  "
+          f"median={timings[len(timings) // 2] * 1000:9.2f} ms  max={timings[-1] * 1000:9.2f} ms")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
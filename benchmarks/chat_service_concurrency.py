@@ -0,0 +1,52 @@
+"""
+chat_service_concurrency.py
+
+Description:
+    Measures chat turns per second through the headless ChatService with many concurrent sessions, with and without
+    batching of the embedding and kNN requests. LLM calls go to the offline LocalBedrockClient with a fixed latency,
+    so only the service's own overhead and the retrieval work vary.
+
+    Requires a built knowledge base (data_store, entities.db, vector_index.bin).
+
+Usage:
+    python -m benchmarks.chat_service_concurrency [concurrent_users] [turns_per_user]
+"""
+import asyncio
+import sys
+import time
+
+from services.chat.local_bedrock import LocalBedrockClient
+from services.chat.service import ChatService
+
+QUESTIONS = ["How many customers do we have?", "What were last week's orders?", "Which product sells best?",
+             "Total sales per region", "Who are the top five customers?"]
+
+
+def responder(prompt):
+    return "SELECT 1" if "SQLite query" in prompt else "An answer."
+
+
+def measure(users, turns, batch_size):
+    service = ChatService(LocalBedrockClient(responder, latency=0.05), max_concurrency=users,
+                          batch_size=batch_size).start()
+
+    async def user(number):
+        for turn in range(turns):
+            await service.ask(f"user-{number}", QUESTIONS[(number + turn) % len(QUESTIONS)] + f" ({number}/{turn})")
+
+    async def all_users():
+        await asyncio.gather(*[user(number) for number in range(users)])
+
+    start = time.perf_counter()
+    service.run(all_users())
+    elapsed = time.perf_counter() - start
+    per_batch = service.embeddings.items / max(service.embeddings.batches, 1)
+    print(f"batch_size={batch_size:3d}  turns={users * turns:5d}  {users * turns / elapsed:8.2f} turns/s  "
+          f"embeddings per batch={per_batch:6.2f}")
+
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    for batch_size in (1, 32):
+        measure(users, turns, batch_size)
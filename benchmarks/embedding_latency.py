@@ -0,0 +1,50 @@
+"""
+embedding_latency.py
+
+Description:
+    Compares the per-call latency of generate_embedding when the model is constructed on every call (the old
+    behaviour) against the shared, warmed-up model from the process-wide registry.
+
+Usage:
+    python -m benchmarks.embedding_latency [calls]
+"""
+import sys
+import time
+
+from services.embeddings.embed import EmbeddingService, DEFAULT_MODEL_NAME, generate_embedding, warm_up
+
+SAMPLE_TEXT = "How do yesterday's sales compare to last Monday's sales?"
+
+
+def time_calls(func, calls):
+    timings = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    mean = sum(timings) / len(timings)
+    print(f"{label:<24} calls={len(timings):<4} mean={mean * 1000:9.2f} ms  "
+          f"min={timings[0] * 1000:9.2f} ms  max={timings[-1] * 1000:9.2f} ms")
+
+
+def main(calls=5):
+    cold = time_calls(lambda: EmbeddingService(DEFAULT_MODEL_NAME).encode(SAMPLE_TEXT, True), calls)
+    report("load model per call", cold)
+
+    start = time.perf_counter()
+    warm_up()
+    print(f"{'warm-up':<24} {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    warm = time_calls(lambda: generate_embedding(SAMPLE_TEXT), calls)
+    report("shared model", warm)
+
+    print(f"speed-up: {(sum(cold) / sum(warm)):.1f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
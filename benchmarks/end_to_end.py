@@ -0,0 +1,274 @@
+"""
+end_to_end.py
+
+Description:
+    Offline end-to-end benchmark of the whole pipeline on synthetic sales data: CSV ingestion
+    (parse_csv_and_save_to_db), entity extraction (create_knowledge_base), embedding and indexing
+    (generate_embeddings) and full chat turns through the ChatService, with a deterministic LocalBedrockClient in
+    place of Bedrock. Everything runs in a scratch directory, so existing data stores and indexes are untouched.
+
+    For every stage it reports the throughput, p50/p95 latency and the peak memory allocated while it ran (as seen by
+    tracemalloc, which includes numpy and pandas buffers but not the model's native allocations). The chat turn is
+    also broken down into its traced stages. The embedding model is the real one, so the first run downloads it.
+
+    A report saved with --output can be passed back as --baseline; the run then fails if any stage's p95 is more
+    than --tolerance slower than in the baseline.
+
+Usage:
+    python -m benchmarks.end_to_end [--rows 100000] [--turns 50] [--users 4] [--output report.json]
+                                    [--baseline report.json] [--tolerance 0.25]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import kb_pipeline
+from services.chat.local_bedrock import LocalBedrockClient
+from services.chat.service import ChatService
+from services.monitoring import tracing
+
+REGIONS = ["North", "South", "East", "West", "Central"]
+SEGMENTS = ["Retail", "Wholesale", "Online"]
+CATEGORIES = ["Acoustic Drums", "Acoustic Guitars", "Electric Guitars", "Keyboards", "Strings", "Amplifiers"]
+
+# Benchmark questions and the SQL the stand-in model answers them with
+QUESTIONS = {
+    "What was the total revenue last month?":
+        "SELECT SUM(Revenue) FROM Sales WHERE substr(Date, 4, 7) = '02/2024'",
+    "Which region sold the most units?":
+        "SELECT Region, SUM(Quantity) AS units FROM Sales GROUP BY Region ORDER BY units DESC LIMIT 1",
+    "Who are our top five customers by revenue?":
+        "SELECT \"Customer Name\", SUM(Revenue) AS revenue FROM Sales GROUP BY \"Customer Name\" "
+        "ORDER BY revenue DESC LIMIT 5",
+    "How much revenue did each product category bring in?":
+        "SELECT \"Product category\", SUM(Revenue) FROM Sales GROUP BY \"Product category\"",
+    "How many wholesale customers are there in the North?":
+        "SELECT COUNT(*) FROM Customers WHERE Segment = 'Wholesale' AND Region = 'North'",
+    "What is the average unit price of keyboards?":
+        "SELECT AVG(\"Unit Price\") FROM Products WHERE \"Product category\" = 'Keyboards'",
+    "How do yesterday's sales compare to last Monday's sales?":
+        "SELECT Date, SUM(Revenue) FROM Sales WHERE Date IN ('14/03/2024', '11/03/2024') GROUP BY Date",
+    "Which products sold fewer than 100 units?":
+        "SELECT Product, SUM(Quantity) AS units FROM Sales GROUP BY Product HAVING units < 100",
+}
+
+
+def write_sales_tables(data_dir, rows, seed=0):
+    """
+    Writes Sales (rows rows), Customers and Products CSV files in the data store's ';'-separated format.
+    """
+    rng = np.random.default_rng(seed)
+    customers = max(rows // 20, 10)
+    products = 200
+
+    product_names = np.char.add("Product ", np.arange(products).astype(str)).astype(object)
+    product_categories = rng.choice(CATEGORIES, products)
+    pd.DataFrame({
+        "Product": product_names,
+        "Product category": product_categories,
+        "Unit Price": rng.integers(20, 5000, products)
+    }).to_csv(os.path.join(data_dir, "Products.csv"), sep=";", index=False)
+
+    customer_names = np.char.add("Customer ", np.arange(customers).astype(str)).astype(object)
+    pd.DataFrame({
+        "Customer Name": customer_names,
+        "Segment": rng.choice(SEGMENTS, customers),
+        "Region": rng.choice(REGIONS, customers)
+    }).to_csv(os.path.join(data_dir, "Customers.csv"), sep=";", index=False)
+
+    product = rng.integers(0, products, rows)
+    pd.DataFrame({
+        "Date": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 90, rows), unit="D"),
+        "Customer Name": customer_names[rng.integers(0, customers, rows)],
+        "Product": product_names[product],
+        "Product category": product_categories[product],
+        "Region": rng.choice(REGIONS, rows),
+        "Quantity": rng.integers(1, 20, rows),
+        "Revenue": rng.integers(100, 500000, rows)
+    }).assign(Date=lambda df: df["Date"].dt.strftime("%d/%m/%Y")).to_csv(
+        os.path.join(data_dir, "Sales.csv"), sep=";", index=False)
+
+
+def responder(prompt):
+    """
+    Deterministic stand-in for the model: the SQL prompt gets the SQL of its benchmark question, the suggested
+    questions prompt three benchmark questions, and anything else a short answer.
+    """
+    if "construct a SQLite query" in prompt:
+        for question, sql in QUESTIONS.items():
+            if question in prompt:
+                return sql
+        return "SELECT COUNT(*) FROM Sales"
+    if "Generate a list of 3 questions" in prompt:
+        return "\n".join(f"{number}. {question}" for number, question in enumerate(list(QUESTIONS)[:3], 1))
+    return "Based on the available data, the answer is shown in the table above."
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))]
+
+
+class StageTimer:
+    """
+    Times repeated runs of a stage and tracks the peak memory allocated while it runs.
+    """
+
+    def __init__(self, name, memory=True):
+        self.name = name
+        self.memory = memory
+        self.durations = []
+        self.items = 0
+        self.peak = 0
+
+    def __enter__(self):
+        if self.memory:
+            tracemalloc.reset_peak()
+            self._baseline = tracemalloc.get_traced_memory()[0]
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.durations.append(time.perf_counter() - self._started)
+        if self.memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1] - self._baseline)
+        return False
+
+    def report(self, wall_time=None):
+        wall_time = wall_time or sum(self.durations)
+        return {"runs": len(self.durations), "items": self.items,
+                "throughput": self.items / wall_time if wall_time else None,
+                "p50": percentile(self.durations, 0.5), "p95": percentile(self.durations, 0.95),
+                "peak_mb": self.peak / 2 ** 20 if self.memory else None}
+
+
+def build(rows, repeat, memory):
+    reports = {}
+    for name in ("ingest", "knowledge_base", "embeddings"):
+        reports[name] = StageTimer(name, memory)
+
+    for _ in range(repeat):
+        with reports["ingest"] as timer:
+            tables = kb_pipeline.parse_csv_and_save_to_db()
+        timer.items += rows
+        with reports["knowledge_base"] as timer:
+            entities = kb_pipeline.create_knowledge_base(tables)
+        timer.items += entities["entities"]
+        with reports["embeddings"] as timer:
+            kb_pipeline.generate_embeddings("entities.db", "vector_index.bin")
+        timer.items += entities["entities"]
+    return {name: timer.report() for name, timer in reports.items()}
+
+
+def chat(turns, users, llm_latency, memory):
+    tracer = tracing.enable()
+    service = ChatService(LocalBedrockClient(responder, latency=llm_latency), max_concurrency=users).start()
+    questions = list(QUESTIONS)
+    timer = StageTimer("chat_turn", memory)
+    timer.items = turns
+
+    async def user(number):
+        for turn in range(number, turns, users):
+            started = time.perf_counter()
+            await service.ask(f"user-{number}", questions[turn % len(questions)])
+            timer.durations.append(time.perf_counter() - started)
+
+    async def all_users():
+        await asyncio.gather(*[user(number) for number in range(users)])
+
+    if memory:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    service.run(all_users())
+    wall_time = time.perf_counter() - started
+    if memory:
+        timer.peak = tracemalloc.get_traced_memory()[1] - baseline
+
+    reports = {"chat_turn": timer.report(wall_time)}
+    for name, summary in tracer.summary("stage.").items():
+        reports[f"  {name}"] = {"runs": summary["count"], "items": summary["count"], "throughput": None,
+                                "p50": summary["p50"], "p95": summary["p95"], "peak_mb": None}
+    tracing.disable()
+    return reports
+
+
+def print_report(reports):
+    print(f"{'stage':<24}{'runs':>6}{'items':>10}{'items/s':>12}{'p50 ms':>12}{'p95 ms':>12}{'peak MB':>10}")
+    for name, report in reports.items():
+        throughput = f"{report['throughput']:12.1f}" if report["throughput"] else f"{'-':>12}"
+        peak = f"{report['peak_mb']:10.1f}" if report["peak_mb"] is not None else f"{'-':>10}"
+        print(f"{name:<24}{report['runs']:>6}{report['items']:>10}{throughput}{report['p50'] * 1000:12.2f}"
+              f"{report['p95'] * 1000:12.2f}{peak}")
+
+
+def regressions(reports, baseline, tolerance):
+    found = []
+    for name, report in reports.items():
+        previous = baseline.get(name)
+        if previous and previous["p95"] and report["p95"] > previous["p95"] * (1 + tolerance):
+            found.append(f"{name.strip()}: p95 {previous['p95'] * 1000:.2f} ms -> {report['p95'] * 1000:.2f} ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark on synthetic sales data.")
+    parser.add_argument("--rows", type=int, default=100_000, help="Rows of the synthetic Sales table")
+    parser.add_argument("--repeat", type=int, default=1, help="Times to run the build stages")
+    parser.add_argument("--turns", type=int, default=50, help="Chat turns to run")
+    parser.add_argument("--users", type=int, default=4, help="Concurrent chat sessions")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Simulated seconds per model response")
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc, which slows every stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Save the report as JSON")
+    parser.add_argument("--baseline", help="A saved report to compare p95 latencies against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed p95 slowdown against the baseline")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["stages"]
+
+    memory = not args.no_memory
+    if memory:
+        tracemalloc.start()
+
+    workdir = tempfile.mkdtemp(prefix="chat-benchmark-")
+    cwd = os.getcwd()
+    try:
+        # The pipeline works on relative paths (data/, data_store, entities.db, ...), so it runs in the scratch dir
+        os.chdir(workdir)
+        os.makedirs(kb_pipeline.directory)
+        write_sales_tables(kb_pipeline.directory, args.rows, args.seed)
+        reports = build(args.rows, args.repeat, memory)
+        reports.update(chat(args.turns, args.users, args.llm_latency, memory))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(reports)
+    if output:
+        with open(output, "w") as f:
+            json.dump({"arguments": vars(args), "stages": reports}, f, indent=2)
+
+    if baseline:
+        found = regressions(reports, baseline, args.tolerance)
+        for regression in found:
+            print("Regression:", regression)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
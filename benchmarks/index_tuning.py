@@ -0,0 +1,65 @@
+"""
+index_tuning.py
+
+Description:
+    Measures recall@k against exact search and query latency of the HNSW index across M, ef_construction and ef
+    settings, on synthetic entity embeddings of increasing size. The embeddings are drawn around a few thousand
+    cluster centres to mimic the many near-duplicate field values of a real knowledge base.
+
+Usage:
+    python -m benchmarks.index_tuning [--sizes 1000 10000 100000 1000000] [--dim 768] [--k 20]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from services.data.store import IndexingService
+
+M_VALUES = [8, 16, 32]
+EF_CONSTRUCTION_VALUES = [100, 200]
+EF_VALUES = [16, 32, 64, 100, 200, 400, 800]
+
+
+def synthetic_embeddings(count, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(max(count // 50, 1), dim)).astype(np.float32)
+    vectors = centres[rng.integers(0, len(centres), count)] + rng.normal(scale=0.3, size=(count, dim)).astype(
+        np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def main(sizes, dim, k, queries_count):
+    print(f"{'items':>9} {'M':>3} {'ef_c':>5} {'build s':>8} {'ef':>5} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8}")
+    for size in sizes:
+        data = synthetic_embeddings(size, dim)
+        queries = synthetic_embeddings(queries_count, dim, seed=1)
+        for M in M_VALUES:
+            for ef_construction in EF_CONSTRUCTION_VALUES:
+                service = IndexingService(dim=dim, max_elements=size, M=M, ef_construction=ef_construction)
+                start = time.perf_counter()
+                service.add_items(data, np.arange(size))
+                build_time = time.perf_counter() - start
+                exact = service.exact_query(queries, k)
+
+                for ef in EF_VALUES:
+                    service.index.set_ef(ef)
+                    recall = service.recall(queries, k, exact)
+                    timings = []
+                    for query in queries:
+                        start = time.perf_counter()
+                        service.query(query[None, :], k=k)
+                        timings.append(time.perf_counter() - start)
+                    timings.sort()
+                    print(f"{size:>9} {M:>3} {ef_construction:>5} {build_time:>8.2f} {ef:>5} {recall:>7.3f} "
+                          f"{timings[len(timings) // 2] * 1000:>8.3f} {timings[int(len(timings) * 0.95)] * 1000:>8.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    main(args.sizes, args.dim, args.k, args.queries)
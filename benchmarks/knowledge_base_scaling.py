@@ -0,0 +1,46 @@
+"""
+knowledge_base_scaling.py
+
+Description:
+    Times build_table_entities over synthetic tables of increasing size to check that building the entity
+    catalogue scales linearly with the number of rows.
+
+Usage:
+    python -m benchmarks.knowledge_base_scaling [rows ...]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from kb_pipeline import build_table_entities
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+
+
+def synthetic_table(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'Date': pd.date_range('2024-01-01', periods=rows, freq='min').strftime('%d/%m/%Y'),
+        'Customer Name': np.char.add('Customer ', rng.integers(0, 5000, rows).astype(str)).astype(object),
+        'Product category': rng.choice(['Acoustic Drums', 'Acoustic Guitars', 'Keyboards', 'Strings'], rows),
+        'Revenue': rng.integers(100, 500000, rows)
+    })
+
+
+def main(sizes):
+    baseline = None
+    for rows in sizes:
+        df = synthetic_table(rows)
+        start = time.perf_counter()
+        entities, _ = build_table_entities("SyntheticSales", df)
+        elapsed = time.perf_counter() - start
+        per_row = elapsed / rows * 1e6
+        baseline = baseline or per_row
+        print(f"rows={rows:<10} entities={len(entities):<10} time={elapsed:8.3f} s  "
+              f"per row={per_row:7.3f} us  ratio={per_row / baseline:5.2f}")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,72 @@
+"""
+retrieval_quality.py
+
+Description:
+    Compares vector-only, lexical-only (FTS5/BM25) and hybrid (reciprocal rank fusion) retrieval over the
+    knowledge base built from the sample CSVs. Each field entity becomes a question that mentions its value
+    exactly, e.g. "What is the revenue of Keilwerth SX90R?", and the entity is the one relevant result.
+    Reports recall@k, mean reciprocal rank and per-query latency.
+
+    Requires a built knowledge base (python kb_pipeline.py build).
+
+Usage:
+    python -m benchmarks.retrieval_quality [questions] [k]
+"""
+import random
+import sqlite3
+import sys
+import time
+
+from services.data.search import vector_search, lexical_search, hybrid_search
+from services.data.store import IndexingService
+from services.embeddings.embed import generate_embedding, warm_up, DEFAULT_MODEL_NAME
+
+TEMPLATES = [
+    "What is the revenue of {}?",
+    "How did {} do last week?",
+    "Show me the numbers for {}",
+]
+
+
+def sample_questions(database_path, count, seed=0):
+    with sqlite3.connect(database_path) as conn:
+        rows = conn.execute("SELECT id, entity_name FROM entities WHERE entity_type = 'sqlite field' "
+                            "AND entity_name IS NOT NULL").fetchall()
+    rng = random.Random(seed)
+    rows = rng.sample(rows, min(count, len(rows)))
+    return [(entity_id, rng.choice(TEMPLATES).format(name)) for entity_id, name in rows]
+
+
+def evaluate(name, search, questions, k):
+    hits = 0
+    reciprocal_ranks = 0.0
+    timings = []
+    for entity_id, question in questions:
+        start = time.perf_counter()
+        ranking = search(question)[:k]
+        timings.append(time.perf_counter() - start)
+        if entity_id in ranking:
+            hits += 1
+            reciprocal_ranks += 1.0 / (ranking.index(entity_id) + 1)
+    timings.sort()
+    print(f"{name:<8} recall@{k}={hits / len(questions):6.3f}  MRR={reciprocal_ranks / len(questions):6.3f}  "
+          f"p50={timings[len(timings) // 2] * 1000:8.2f} ms  p95={timings[int(len(timings) * 0.95)] * 1000:8.2f} ms")
+
+
+def main(count=200, k=20):
+    service = IndexingService(model_name=DEFAULT_MODEL_NAME)
+    service.load_index("vector_index.bin")
+    warm_up()
+    questions = sample_questions("entities.db", count)
+
+    # Embeddings are computed up front so that only retrieval is timed
+    embeddings = {question: generate_embedding(question) for _, question in questions}
+
+    evaluate("vector", lambda question: vector_search(service, embeddings[question], k), questions, k)
+    evaluate("lexical", lambda question: lexical_search("entities.db", question, k), questions, k)
+    evaluate("hybrid", lambda question: hybrid_search(service, embeddings[question], question, "entities.db", k),
+             questions, k)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,68 @@
+"""
+sql_cache_threshold.py
+
+Description:
+    Checks that the semantic SQL cache keeps apart questions that differ only in their dates or numbers, and that it
+    still serves repeated questions. Every pair is embedded with the real model; the first question is stored in a
+    scratch cache and the second looked up. The report shows each pair's cosine similarity against the threshold and
+    whether the lookup hit.
+
+    Exits with status 1 if a pair with different dates hits, or a repeated question misses.
+
+Usage:
+    python -m benchmarks.sql_cache_threshold [threshold]
+"""
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from services.chat.sql_cache import SemanticSQLCache, SIMILARITY_THRESHOLD
+from services.embeddings.embed import generate_embeddings_batch
+
+# Pairs whose SQL differs only in a date, period or number; none of them may hit
+DIFFERENT_DATES = [
+    ("What were the total sales on 12/03/2024?", "What were the total sales on 13/03/2024?"),
+    ("What were the total sales in March 2024?", "What were the total sales in April 2024?"),
+    ("How many orders did we get yesterday?", "How many orders did we get today?"),
+    ("What was the revenue last week?", "What was the revenue this week?"),
+    ("How much did we sell on Monday?", "How much did we sell on Tuesday?"),
+    ("What was the revenue in Q1 2024?", "What was the revenue in Q2 2024?"),
+    ("Which products sold fewer than 100 units?", "Which products sold fewer than 10 units?"),
+]
+
+# Questions asked again, verbatim or without the question mark; all of them should hit
+REPEATED = [
+    ("Which region sold the most units?", "Which region sold the most units?"),
+    ("Who are our top five customers by revenue?", "Who are our top five customers by revenue"),
+    ("What was the revenue in March 2024?", "What was the revenue in March 2024?"),
+]
+
+
+def check(threshold):
+    texts = [text for pair in DIFFERENT_DATES + REPEATED for text in pair]
+    embeddings = np.asarray(generate_embeddings_batch(texts), dtype=np.float32)
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    failures = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for number, (first, second) in enumerate(DIFFERENT_DATES + REPEATED):
+            cache = SemanticSQLCache(os.path.join(workdir, f"pair-{number}.db"), threshold=threshold)
+            first_embedding, second_embedding = embeddings[2 * number], embeddings[2 * number + 1]
+            cache.store(first_embedding, first, "SELECT 1", "schema")
+            hit = cache.lookup(second_embedding, "schema", second) is not None
+            should_hit = number >= len(DIFFERENT_DATES)
+            similarity = float(first_embedding @ second_embedding)
+            status = "ok" if hit == should_hit else "FAIL"
+            print(f"{status:<5}{similarity:8.4f}  {'hit ' if hit else 'miss'}  {first!r} -> {second!r}")
+            if hit != should_hit:
+                failures.append((first, second))
+    return failures
+
+
+if __name__ == '__main__':
+    threshold = float(sys.argv[1]) if len(sys.argv) > 1 else SIMILARITY_THRESHOLD
+    print(f"Threshold {threshold}")
+    if check(threshold):
+        sys.exit(1)
@@ -11,12 +11,22 @@ Author: [Your Name]
 Date: [Date of Creation]
 Version: [Version of the Script]
 """
+import argparse
+import hashlib
 import sqlite3
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 
-from services.data.oper import read_csv_to_dataframe, read_table_to_dataframe, fetch_entity_by_id, summarize_schema
-from services.data.store import dataframe_to_sqlite, IndexingService
+from services.chat.prompts import build_sql_prompt
+from services.data.oper import read_table_to_dataframe, fetch_entities_by_ids
+from services.data.schema import get_schema_summary, refresh_schema_catalogue
+from services.data.search import build_entity_search_index
+from services.data.store import (dataframe_to_sqlite, csv_to_sqlite, csvs_to_sqlite, IndexingService,
+                                 IndexManifestError, CSV_CHUNKSIZE)
 
-from services.embeddings.embed import generate_embedding
+from services.embeddings.embed import generate_embedding, generate_embeddings_batch, DEFAULT_MODEL_NAME
+from services.embeddings.vector_store import EmbeddingStore, EmbeddingStoreWriter, rewrite_embedding_store
 
 import os
 import pandas as pd
@@ -24,134 +34,483 @@ import numpy as np
 
 directory = "data"
 
+# Recall@20 the vector index is tuned for after every build
+TARGET_RECALL = 0.95
+# Refreshes re-tune ef once the items added or deleted since the last tuning exceed this fraction of the index
+RETUNE_FRACTION = 0.1
 
-def parse_csv_and_save_to_db():
-    file_paths = []
-    file_names = []
-    for filename in os.listdir(directory):
+# Side store of the raw embeddings, so the index can be rebuilt without the model
+EMBEDDING_STORE = "embeddings"
+EMBEDDING_STORE_DTYPE = "float16"
+
+
+def list_csv_files(data_dir=None):
+    """
+    Returns (file_path, table_name) pairs for every CSV file in the data directory.
+    """
+    data_dir = data_dir or directory
+    files = []
+    for filename in sorted(os.listdir(data_dir)):
         if filename.endswith('.csv'):
-            file_path = os.path.join(directory, filename)
-            file_name = os.path.splitext(filename)[0]
+            files.append((os.path.join(data_dir, filename), os.path.splitext(filename)[0]))
+    return files
+
+
+def parse_csv_and_save_to_db(workers=None, chunksize=CSV_CHUNKSIZE, dtype=None):
+    """
+    Streams every CSV file in the data directory into its own table of the data store, optionally parsing the
+    files in parallel processes. dtype maps column names to explicit types for every file with that column;
+    other columns are inferred per file.
+    """
+    files = list_csv_files()
+    csvs_to_sqlite(files, "data_store", workers, chunksize, dtype=dtype)
+
+    return [file_name for _, file_name in files]
+
+
+ENTITY_COLUMNS = ['id', 'entity_type', 'entity_name', 'entity_description', 'occurrences', 'table_name',
+                  'content_hash']
+
+
+@dataclass
+class EntityExtraction:
+    """
+    Settings for how field values are turned into entities.
+
+    distinct: store each (table, column, value) once with its occurrence count instead of once per cell.
+    max_distinct: columns with more distinct values than this are treated as high-cardinality.
+    max_avg_length: columns whose values average more characters than this are treated as free text.
+    policy: what to do with high-cardinality and free-text columns, "skip" or "sample".
+    sample_size: how many of the most frequent values to keep when sampling.
+    """
+    distinct: bool = True
+    max_distinct: int = 10000
+    max_avg_length: int = 200
+    policy: str = "sample"
+    sample_size: int = 1000
+
+
+def entity_texts(entities):
+    """
+    Returns the text that is embedded for each entity, matching the text built by iter_entity_chunks.
+    """
+    return (entities['entity_type'].astype(str) + " " + entities['entity_name'].astype(str) + " "
+            + entities['entity_description'].astype(str))
+
 
-            file_paths.append(file_path)
-            file_names.append(file_name)
+def _content_hashes(entities):
+    # 64-bit hashes of the embedded text, stored as signed integers so SQLite accepts them
+    return pd.util.hash_pandas_object(entity_texts(entities), index=False).to_numpy().view(np.int64)
 
-    for file_path, file_name in zip(file_paths, file_names):
-        df = read_csv_to_dataframe(file_path)
-        dataframe_to_sqlite(file_name, df)
 
-    return file_names
+def _entity_frame(start_id, entity_type, names, description, occurrences, table_name):
+    """
+    Builds a block of entities with consecutive ids starting at start_id that share a type and description.
+    """
+    names = np.asarray(names, dtype=object)
+    entities = pd.DataFrame({
+        'id': np.arange(start_id, start_id + len(names), dtype=np.int64),
+        'entity_type': entity_type,
+        'entity_name': names,
+        'entity_description': description,
+        'occurrences': occurrences,
+        'table_name': table_name
+    }, columns=ENTITY_COLUMNS)
+    entities['content_hash'] = _content_hashes(entities)
+    return entities
+
+
+def _field_values(column_data, extraction):
+    """
+    Returns the (values, occurrence counts) to store for a string column under the given extraction settings.
+    """
+    if not extraction.distinct:
+        return column_data.to_numpy(dtype=object), 1
+
+    # Distinct values in order of first appearance so ids are deterministic
+    codes, uniques = pd.factorize(column_data)
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    values = np.asarray(uniques, dtype=object)
+
+    lengths = column_data.dropna().astype(str).str.len()
+    high_cardinality = len(values) > extraction.max_distinct
+    free_text = len(lengths) > 0 and lengths.mean() > extraction.max_avg_length
+    if high_cardinality or free_text:
+        if extraction.policy == "skip":
+            return values[:0], counts[:0]
+        # Keep the most frequent values; the stable sort preserves first-appearance order on ties
+        keep = np.sort(np.argsort(-counts, kind="stable")[:extraction.sample_size])
+        return values[keep], counts[keep]
+
+    return values, counts
+
+
+def build_table_entities(table_name, df, start_id=1, extraction=None):
+    """
+    Builds the entity catalogue of a single table column by column.
+
+    Ids are assigned deterministically in table order: the fields of each string column, followed by the column
+    itself, and finally the table.
+
+    Returns:
+    tuple: (pd.DataFrame of entities, next free id)
+    """
+    extraction = extraction or EntityExtraction()
+    frames = []
+    i = start_id
+    column_names = []
+    for column_name, column_data in df.items():
+        column_names.append(column_name)
+        if column_data.dtype == 'object' or pd.api.types.is_string_dtype(column_data):
+            values, counts = _field_values(column_data, extraction)
+            frames.append(_entity_frame(i, "sqlite field", values,
+                                        f"""is a field in "{column_name}" column in {table_name} table.""", counts,
+                                        table_name))
+            i += len(values)
+
+        frames.append(_entity_frame(i, "sqlite column", [column_name],
+                                    f"""is a column in "{table_name}" table and contains {column_data.dtype} data.""",
+                                    len(df), table_name))
+        i += 1
+
+    frames.append(_entity_frame(i, "sqlite table", [table_name],
+                                f"""is a table name. It contains the following columns: {column_names}""", len(df),
+                                table_name))
+    i += 1
+
+    return pd.concat(frames, ignore_index=True), i
+
+
+def _undeduplicated_entity_count(df):
+    """
+    The number of entities a table yields when every cell of every string column becomes an entity.
+    """
+    string_cells = sum(len(column_data) for _, column_data in df.items()
+                       if column_data.dtype == 'object' or pd.api.types.is_string_dtype(column_data))
+    return string_cells + len(df.columns) + 1
+
 
+def create_knowledge_base(table_names, extraction=None):
+    """
+    Builds the entities table in entities.db from the given tables of the data store.
 
-def create_knowledge_base(table_names):
-    entities_df = pd.DataFrame({
-        'id': [None],
-        'entity_type': [""],
-        'entity_name': [""],
-        'entity_description': [""]
-    })
-    entities_df = entities_df.iloc[0:0]
+    Returns:
+    dict: The number of entities written, the number one entity per cell would have produced, and the reduction.
+    """
+    frames = []
     i = 1
+    full_count = 0
     for table_name in table_names:
         df = read_table_to_dataframe(table_name)
-        column_names = []
-        for column_name, column_data in df.items():
-            column_names.append(column_name)
-            if df[column_name].dtype == 'object' or pd.api.types.is_string_dtype(
-                    df[column_name]):
-                for item in column_data:
-                    entities_df = entities_df._append({
-                        "id": i,
-                        "entity_type": "sqlite field",
-                        "entity_name": item,
-                        "entity_description": f"""is a field in "{column_name}" column in {table_name} table."""
-                    }, ignore_index=True)
-                    i += 1
-
-            entities_df = entities_df._append({
-                "id": i,
-                "entity_type": "sqlite column",
-                "entity_name": column_name,
-                "entity_description": f"""is a column in "{table_name}" table and contains {df[column_name].dtype} data."""
-            }, ignore_index=True)
-            i += 1
-
-        entities_df = entities_df._append({
-            "id": i,
-            "entity_type": "sqlite table",
-            "entity_name": table_name,
-            "entity_description": f"""is a table name. It contains the following columns: {column_names}"""
-        }, ignore_index=True)
-        i += 1
+        entities, i = build_table_entities(table_name, df, i, extraction)
+        frames.append(entities)
+        full_count += _undeduplicated_entity_count(df)
+
+    if frames:
+        entities_df = pd.concat(frames, ignore_index=True)
+    else:
+        entities_df = pd.DataFrame(columns=ENTITY_COLUMNS)
 
     dataframe_to_sqlite("Entities", entities_df, "entities.db")
+    build_entity_search_index("entities.db")
+
+    report = {
+        "entities": len(entities_df),
+        "entities_without_dedup": full_count,
+        "reduction": 1 - len(entities_df) / full_count if full_count else 0.0
+    }
+    print(f"Knowledge base has {report['entities']} entities instead of {report['entities_without_dedup']} "
+          f"({report['reduction']:.1%} smaller index)")
+    return report
 
 
-def generate_embeddings(database_path, index_path):
+def iter_entity_chunks(database_path, chunk_size=1000):
     """
-    Generate embeddings for entities in the entities.db SQLite database and save to disk.
+    Streams (ids, texts) chunks out of the entities table without loading the whole table in memory.
+    Entities whose concatenated text is empty are skipped.
     """
-    # Connect to the database
     with sqlite3.connect(database_path) as conn:
         cursor = conn.cursor()
-        # Fetch the id, entity_type, entity_name, and entity_description from the relevant table
-        cursor.execute("SELECT id, entity_type, entity_name, entity_description FROM entities")
-        rows = cursor.fetchall()
-
-    # Generate embeddings
-    entity_ids = []
-    embeddings = []
-    count = 1
-    for entity_id, entity_type, entity_name, entity_description in rows:
-        # Concatenate the entity_type, entity_name, and entity_description
-        full_text = f"{entity_type} {entity_name} {entity_description}"
-        print(f"Generating embedding for entity {entity_id} ({count}/{len(rows)}) with full text: {full_text}")
-        if full_text.strip():  # Ensure there is text to process
-            embedding = generate_embedding(full_text)  # Assuming generate_embedding is defined elsewhere
-            embeddings.append(embedding)
-            entity_ids.append(entity_id)
-
-        count += 1
-
-    # Initialize the indexing service with the correct dimension for the embeddings
-    service = IndexingService(max_elements=1000)
-    service.add_items(np.array(embeddings), entity_ids)
+        cursor.execute("SELECT id, entity_type, entity_name, entity_description FROM entities ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            ids = []
+            texts = []
+            for entity_id, entity_type, entity_name, entity_description in rows:
+                # Concatenate the entity_type, entity_name, and entity_description
+                full_text = f"{entity_type} {entity_name} {entity_description}"
+                if full_text.strip():  # Ensure there is text to process
+                    ids.append(entity_id)
+                    texts.append(full_text)
+            yield ids, texts
+        cursor.close()
+
+
+def _embed_chunk(texts, batch_size):
+    # Runs inside pool workers as well; the model registry loads the model once per process
+    return generate_embeddings_batch(texts, batch_size=batch_size)
+
+
+def _embed_chunks(chunks, batch_size, workers):
+    """
+    Yields (ids, embeddings) for every chunk, in order. With workers > 1 the chunks are embedded in a process pool,
+    keeping at most two chunks per worker in flight so memory stays bounded.
+    """
+    if not workers or workers <= 1:
+        for ids, texts in chunks:
+            if ids:
+                yield ids, _embed_chunk(texts, batch_size)
+        return
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for ids, texts in chunks:
+            if not ids:
+                continue
+            pending.append((ids, executor.submit(_embed_chunk, texts, batch_size)))
+            if len(pending) >= workers * 2:
+                done_ids, future = pending.popleft()
+                yield done_ids, future.result()
+        while pending:
+            done_ids, future = pending.popleft()
+            yield done_ids, future.result()
+
+
+def generate_embeddings(database_path, index_path, chunk_size=1000, batch_size=64, workers=None,
+                        store_path=EMBEDDING_STORE, store_dtype=EMBEDDING_STORE_DTYPE):
+    """
+    Generate embeddings for entities in the entities.db SQLite database and save to disk.
+
+    Rows are streamed from the database in chunks of chunk_size, embedded in batches of batch_size (optionally
+    across a pool of worker processes) and added to the index as each chunk completes. The embeddings are also
+    written to the memory-mapped store at store_path in store_dtype ("float32", "float16" or "int8").
+    """
+    with sqlite3.connect(database_path) as conn:
+        total, = conn.execute("SELECT COUNT(*) FROM entities").fetchone()
+
+    # Initialize the indexing service with room for every entity
+    service = IndexingService(max_elements=max(total, 1), model_name=DEFAULT_MODEL_NAME)
+
+    done = 0
+    with EmbeddingStoreWriter(store_path, total, service.dim, store_dtype, DEFAULT_MODEL_NAME) as store:
+        for ids, embeddings in _embed_chunks(iter_entity_chunks(database_path, chunk_size), batch_size, workers):
+            service.add_items(np.asarray(embeddings), ids)
+            store.append(ids, embeddings)
+            done += len(ids)
+            print(f"Embedded {done}/{total} entities")
+
+    ef, recall = service.tune_ef(TARGET_RECALL, store=EmbeddingStore(store_path))
+    print(f"Using ef={ef} for a recall@20 of {recall:.3f}")
 
     # Save the index to disk
     service.save_index(index_path)
 
 
-if __name__ == '__main__':
-    # table_names = parse_csv_and_save_to_db()
+def build_index_from_store(store_path=EMBEDDING_STORE, index_path="vector_index.bin", M=16, ef_construction=200,
+                           target_recall=TARGET_RECALL):
+    """
+    Rebuilds the vector index from the embedding store, e.g. with different HNSW parameters, without running the
+    embedding model.
+    """
+    store = EmbeddingStore(store_path)
+    service = IndexingService(dim=store.dim, max_elements=max(len(store), 1), model_name=store.model_name, M=M,
+                              ef_construction=ef_construction)
+    for ids, embeddings in store.iter_chunks():
+        service.add_items(embeddings, ids)
+    ef, recall = service.tune_ef(target_recall, store=store)
+    print(f"Indexed {len(store)} embeddings, using ef={ef} for a recall@20 of {recall:.3f}")
+    service.save_index(index_path)
+
+
+def file_fingerprint(file_path, block_size=1 << 20):
+    """
+    Returns the SHA-256 hex digest of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-    # create_knowledge_base(table_names)
 
-    # generate_embeddings('entities.db', 'vector_index.bin')
+def _load_source_fingerprints(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS source_files (table_name TEXT PRIMARY KEY, content_hash TEXT)")
+    return dict(conn.execute("SELECT table_name, content_hash FROM source_files").fetchall())
 
-    user_prompt = "How do yesterday's sales compare to last Monday’s sales?"
 
-    service = IndexingService()
+def _save_source_fingerprints(conn, fingerprints):
+    conn.execute("DELETE FROM source_files")
+    conn.executemany("INSERT INTO source_files (table_name, content_hash) VALUES (?, ?)", fingerprints.items())
+
+
+def _has_incremental_state(entities_db, index_path):
+    """
+    Whether a previous build left everything an incremental refresh needs: the index, its entities with table names
+    and content hashes, and the CSV fingerprints.
+    """
+    if not (os.path.exists(entities_db) and os.path.exists(index_path)):
+        return False
+    with sqlite3.connect(entities_db) as conn:
+        tables = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        if "source_files" not in tables or "Entities" not in tables:
+            return False
+        columns = {column[1] for column in conn.execute("PRAGMA table_info(entities)")}
+    return {"table_name", "content_hash"} <= columns
+
+
+def build_knowledge_base(entities_db="entities.db", index_path="vector_index.bin", extraction=None, **embed_options):
+    """
+    Full rebuild: reloads every CSV, rebuilds the entities table and re-embeds every entity.
+    """
+    fingerprints = {table_name: file_fingerprint(file_path) for file_path, table_name in list_csv_files()}
+    table_names = parse_csv_and_save_to_db()
+    refresh_schema_catalogue("data_store")
+    create_knowledge_base(table_names, extraction)
+    generate_embeddings(entities_db, index_path, **embed_options)
+    with sqlite3.connect(entities_db) as conn:
+        _load_source_fingerprints(conn)
+        _save_source_fingerprints(conn, fingerprints)
+
+
+def refresh_knowledge_base(entities_db="entities.db", index_path="vector_index.bin", extraction=None,
+                           batch_size=64, store_path=EMBEDDING_STORE):
+    """
+    Incrementally brings the data store, entities table and vector index up to date with the CSV files.
+
+    Only tables whose CSV changed are reloaded. Their entities are matched to the previous ones by content hash, so
+    unchanged entities keep their ids and vectors, new or changed entities are embedded, and entities that no longer
+    exist are removed from both the entities table and the index. Falls back to a full rebuild when there is no
+    previous state to compare against.
+
+    Returns:
+    dict: Counts of changed tables, removed tables, embedded entities and deleted entities.
+    """
+    if not _has_incremental_state(entities_db, index_path):
+        print("No previous knowledge base state found, running a full rebuild.")
+        build_knowledge_base(entities_db, index_path, extraction, batch_size=batch_size)
+        return {"full_rebuild": True}
+
+    service = IndexingService(model_name=DEFAULT_MODEL_NAME)
+    try:
+        service.load_index(index_path)
+    except IndexManifestError as e:
+        print(f"{e}; running a full rebuild.")
+        build_knowledge_base(entities_db, index_path, extraction, batch_size=batch_size)
+        return {"full_rebuild": True}
+
+    fingerprints = {table_name: (file_path, file_fingerprint(file_path)) for file_path, table_name in list_csv_files()}
+    with sqlite3.connect(entities_db) as conn:
+        previous = _load_source_fingerprints(conn)
+
+    changed = [table_name for table_name, (_, digest) in fingerprints.items() if previous.get(table_name) != digest]
+    removed = [table_name for table_name in previous if table_name not in fingerprints]
+    report = {"changed_tables": len(changed), "removed_tables": len(removed), "embedded": 0, "deleted": 0}
+    if not changed and not removed:
+        print("Knowledge base is up to date.")
+        return report
+
+    for table_name in changed:
+        csv_to_sqlite(fingerprints[table_name][0], table_name)
+    with sqlite3.connect("data_store") as conn:
+        for table_name in removed:
+            conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+    refresh_schema_catalogue("data_store")
+
+    with sqlite3.connect(entities_db) as conn:
+        affected = changed + removed
+        placeholders = ", ".join("?" * len(affected))
+        existing = pd.read_sql(f"SELECT id, content_hash FROM entities WHERE table_name IN ({placeholders})",
+                               conn, params=affected)
+        next_id = (conn.execute("SELECT MAX(id) FROM entities").fetchone()[0] or 0) + 1
+
+    frames = []
+    for table_name in changed:
+        entities, _ = build_table_entities(table_name, read_table_to_dataframe(table_name), 0, extraction)
+        frames.append(entities)
+    entities_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=ENTITY_COLUMNS)
+
+    # Entities whose text is unchanged keep their previous id (and therefore their vector)
+    # (repeated texts only reuse the id once, so ids stay unique)
+    previous_ids = existing.drop_duplicates("content_hash").set_index("content_hash")["id"]
+    matched = entities_df["content_hash"].map(previous_ids).where(~entities_df["content_hash"].duplicated())
+    is_new = matched.isna().to_numpy()
+    ids = matched.fillna(0).to_numpy(dtype=np.int64)
+    ids[is_new] = np.arange(next_id, next_id + is_new.sum(), dtype=np.int64)
+    entities_df["id"] = ids
+
+    stale_ids = np.setdiff1d(existing["id"].to_numpy(dtype=np.int64), ids)
+    report["deleted"] = service.delete_items(stale_ids)
+
+    new_entities = entities_df[is_new]
+    texts = entity_texts(new_entities)
+    keep = texts.str.strip().astype(bool).to_numpy()
+    new_ids = new_entities["id"].to_numpy()[keep]
+    new_embeddings = []
+    for start in range(0, len(new_ids), 1000):
+        chunk_ids = new_ids[start:start + 1000]
+        chunk_texts = texts[keep].iloc[start:start + 1000].tolist()
+        embeddings = np.asarray(generate_embeddings_batch(chunk_texts, batch_size=batch_size))
+        service.add_items(embeddings, chunk_ids)
+        new_embeddings.append(embeddings)
+        report["embedded"] += len(chunk_ids)
+
+    if EmbeddingStore.exists(store_path):
+        rewrite_embedding_store(store_path, stale_ids, new_ids,
+                                np.concatenate(new_embeddings) if new_embeddings else np.empty((0, service.dim)))
+
+    with sqlite3.connect(entities_db) as conn:
+        conn.execute(f"DELETE FROM entities WHERE table_name IN ({placeholders})", affected)
+        entities_df.to_sql("Entities", conn, if_exists="append", index=False)
+        _save_source_fingerprints(conn, {table_name: digest for table_name, (_, digest) in fingerprints.items()})
+    build_entity_search_index(entities_db)
+
+    if service.changes_since_tune > RETUNE_FRACTION * service.count:
+        store = EmbeddingStore(store_path) if EmbeddingStore.exists(store_path) else None
+        ef, recall = service.tune_ef(service.target_recall or TARGET_RECALL, store=store)
+        print(f"Using ef={ef} for a recall@20 of {recall:.3f}")
+    service.save_index(index_path)
+    print(f"Reloaded {len(changed)} tables, removed {len(removed)}, embedded {report['embedded']} entities and "
+          f"deleted {report['deleted']}.")
+    return report
+
+
+def ask(user_prompt):
+    service = IndexingService(model_name=DEFAULT_MODEL_NAME)
 
     service.load_index("vector_index.bin")
 
     prompt_embedding = generate_embedding(user_prompt)
-    prompt_for_sql_query_request = (f"User has asked the following: {user_prompt}, and we have the following database "
-                                    f"schema:\n")
-    prompt_for_sql_query_request += summarize_schema("data_store")
-    prompt_for_sql_query_request += ("\nAlso we have fetched the following information that may or may not be relevant "
-                                     "to the user's question:\n")
 
     labels, distances = service.query(np.array([prompt_embedding]), k=10)
     print("Query results:", labels, distances)
 
-    for i in range(len(labels[0])):
-        label = labels[0][i]
-        info = fetch_entity_by_id("entities.db", int(label))
-        prompt_for_sql_query_request += (str(info) + "\n")
+    prompt_for_sql_query_request, report = build_sql_prompt(user_prompt, get_schema_summary("data_store"),
+                                                            fetch_entities_by_ids("entities.db", labels[0]))
 
-    prompt_for_sql_query_request += ("Your task is to utilize all the above information that have been given to you, "
-                                     "to construct a SQLite query that fetches from the database the answer that the "
-                                     "user requests. Give ONLY the SQL query and nothing else.")
+    print(prompt_for_sql_query_request)
+    print(report)
 
 
-    print(prompt_for_sql_query_request)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Knowledge base pipeline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="Rebuild the data store, entities and vector index from scratch")
+    subparsers.add_parser("refresh", help="Incrementally update only what changed in the CSV files")
+    reindex_parser = subparsers.add_parser("reindex", help="Rebuild the vector index from the stored embeddings")
+    reindex_parser.add_argument("--M", type=int, default=16)
+    reindex_parser.add_argument("--ef-construction", type=int, default=200)
+    reindex_parser.add_argument("--target-recall", type=float, default=TARGET_RECALL)
+    ask_parser = subparsers.add_parser("ask", help="Print the SQL-generation prompt for a question")
+    ask_parser.add_argument("prompt", nargs="?", default="How do yesterday's sales compare to last Monday’s sales?")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_knowledge_base()
+    elif args.command == "refresh":
+        refresh_knowledge_base()
+    elif args.command == "reindex":
+        build_index_from_store(M=args.M, ef_construction=args.ef_construction, target_recall=args.target_recall)
+    else:
+        ask(args.prompt)
@@ -0,0 +1,108 @@
+import json
+import os
+import time
+
+from services.monitoring import tracing
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+MAX_TOKENS = 1000
+
+# Per-attempt limits for LLM stages; the stage runner handles retries, so botocore's own are turned off
+LLM_TIMEOUT = 60
+LLM_RETRIES = 2
+
+
+def create_bedrock_client():
+    """
+    Creates a bedrock-runtime client from the AWS_* environment variables.
+    """
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client('bedrock-runtime', aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                        region_name=os.getenv("AWS_DEFAULT_REGION"),
+                        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                        config=Config(read_timeout=LLM_TIMEOUT, retries={"max_attempts": 0}))
+
+
+def _request_body(prompt, max_tokens):
+    return {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": max_tokens,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    }
+                ]
+            }
+        ]
+    }
+
+
+def request_to_llm(client, prompt, model_id=MODEL_ID, max_tokens=MAX_TOKENS):
+    """
+    Sends a single-turn prompt to a Bedrock Anthropic model and returns the full response text.
+    """
+    with tracing.span("llm.request", prompt_chars=len(prompt)) as span:
+        # Make the API call to invoke the model
+        response = client.invoke_model(
+            modelId=model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps(_request_body(prompt, max_tokens))
+        )
+
+        # Parse and print the response
+        response_body = json.loads(response['body'].read())
+        span.set(**response_body.get("usage", {}))
+
+    return response_body['content'][0]['text']
+
+
+class TextStream:
+    """
+    Streams the response to a prompt through invoke_model_with_response_stream, yielding text deltas as they
+    arrive. Can be passed straight to st.write_stream.
+
+    After iteration, text holds the full response, time_to_first_token the seconds from the request to the first
+    delta, and usage the input and output token counts reported by the model.
+    """
+
+    def __init__(self, client, prompt, model_id=MODEL_ID, max_tokens=MAX_TOKENS):
+        self.started = time.perf_counter()
+        self.time_to_first_token = None
+        self.total_time = None
+        self.usage = {}
+        self.chunks = []
+        self._response = client.invoke_model_with_response_stream(
+            modelId=model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps(_request_body(prompt, max_tokens))
+        )
+
+    @property
+    def text(self):
+        return "".join(self.chunks)
+
+    def __iter__(self):
+        for event in self._response["body"]:
+            chunk = event.get("chunk")
+            if not chunk:
+                continue
+            data = json.loads(chunk["bytes"])
+            if data["type"] == "content_block_delta" and data["delta"].get("type") == "text_delta":
+                if self.time_to_first_token is None:
+                    self.time_to_first_token = time.perf_counter() - self.started
+                self.chunks.append(data["delta"]["text"])
+                yield data["delta"]["text"]
+            elif data["type"] == "message_start":
+                self.usage.update(data["message"].get("usage", {}))
+            elif data["type"] == "message_delta":
+                self.usage.update(data.get("usage", {}))
+        self.total_time = time.perf_counter() - self.started
+        tracing.record("llm.stream", self.total_time, time_to_first_token=self.time_to_first_token, **self.usage)
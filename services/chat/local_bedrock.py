@@ -0,0 +1,68 @@
+import io
+import json
+import time
+
+
+def echo_responder(prompt):
+    return f"You asked: {prompt.strip()[:200]}"
+
+
+class LocalBedrockClient:
+    """
+    A local stand-in for the boto3 bedrock-runtime client that answers Anthropic-format requests without the
+    network, for exercising the chat pipeline offline.
+
+    responder: maps the prompt text to the response text.
+    chunk_size: characters per streamed text delta.
+    latency: seconds to wait before the first byte, to simulate the model.
+    delay: seconds to wait between streamed deltas.
+    """
+
+    def __init__(self, responder=echo_responder, chunk_size=16, latency=0.0, delay=0.0):
+        self.responder = responder
+        self.chunk_size = chunk_size
+        self.latency = latency
+        self.delay = delay
+
+    def _respond(self, body):
+        request = json.loads(body)
+        prompt = "".join(part["text"] for message in request["messages"] for part in message["content"]
+                         if part["type"] == "text")
+        return prompt, self.responder(prompt)
+
+    def invoke_model(self, modelId, body, contentType="application/json", accept="application/json"):
+        prompt, text = self._respond(body)
+        time.sleep(self.latency)
+        payload = {
+            "id": "msg_local",
+            "type": "message",
+            "role": "assistant",
+            "model": modelId,
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "usage": {"input_tokens": len(prompt.split()), "output_tokens": len(text.split())}
+        }
+        return {"body": io.BytesIO(json.dumps(payload).encode()), "contentType": accept}
+
+    def invoke_model_with_response_stream(self, modelId, body, contentType="application/json",
+                                          accept="application/json"):
+        prompt, text = self._respond(body)
+        return {"body": self._events(modelId, prompt, text), "contentType": accept}
+
+    def _events(self, model_id, prompt, text):
+        def event(data):
+            return {"chunk": {"bytes": json.dumps(data).encode()}}
+
+        time.sleep(self.latency)
+        yield event({"type": "message_start", "message": {
+            "id": "msg_local", "type": "message", "role": "assistant", "model": model_id, "content": [],
+            "usage": {"input_tokens": len(prompt.split()), "output_tokens": 0}}})
+        yield event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        for start in range(0, len(text), self.chunk_size):
+            time.sleep(self.delay)
+            yield event({"type": "content_block_delta", "index": 0,
+                         "delta": {"type": "text_delta", "text": text[start:start + self.chunk_size]}})
+        yield event({"type": "content_block_stop", "index": 0})
+        yield event({"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                     "usage": {"output_tokens": len(text.split())}})
+        yield event({"type": "message_stop"})
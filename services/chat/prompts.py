@@ -0,0 +1,305 @@
+import re
+
+from services.data.safe_query import render_query_result, render_result_table
+from services.data.schema import estimate_tokens
+
+HISTORY_TURNS = 3
+
+# Token budget of each prompt; sections are given their share in order of importance and trimmed to fit
+SQL_PROMPT_BUDGET = 3000
+ANSWER_PROMPT_BUDGET = 2000
+QUESTIONS_PROMPT_BUDGET = 1200
+
+# Upper bounds per section within the prompt budgets
+ENTITY_TOKEN_BUDGET = 600
+RESULT_TOKEN_BUDGET = 1200
+HISTORY_TOKEN_BUDGET = 400
+QUESTIONS_CONTEXT_BUDGET = 500
+
+# Older answers are cut to this many characters in the conversation context
+SUMMARY_CHARS = 160
+
+_FIELD_DESCRIPTION = re.compile(r'^is a field in "(.*)" column in (.*) table\.$')
+_COLUMN_DESCRIPTION = re.compile(r'^is a column in "(.*)" table')
+
+
+class PromptReport:
+    """
+    Token counts of a built prompt: for every section, what the unbudgeted rendering would have cost and what it
+    was trimmed to.
+    """
+
+    def __init__(self, stage, budget):
+        self.stage = stage
+        self.budget = budget
+        self.fixed = 0
+        self.sections = {}
+
+    def add(self, name, raw, used):
+        self.sections[name] = (estimate_tokens(raw), estimate_tokens(used))
+
+    @property
+    def tokens(self):
+        return self.fixed + sum(used for _, used in self.sections.values())
+
+    @property
+    def raw_tokens(self):
+        return self.fixed + sum(raw for raw, _ in self.sections.values())
+
+    @property
+    def saved(self):
+        return self.raw_tokens - self.tokens
+
+    def to_dict(self):
+        return {"stage": self.stage, "budget": self.budget, "tokens": self.tokens, "raw_tokens": self.raw_tokens,
+                "saved": self.saved, "sections": {name: {"raw": raw, "used": used}
+                                                  for name, (raw, used) in self.sections.items()}}
+
+    def __str__(self):
+        sections = ", ".join(f"{name} {used}/{raw}" for name, (raw, used) in self.sections.items())
+        return (f"{self.stage} prompt: {self.tokens} tokens of {self.budget}, saved {self.saved} "
+                f"(used/raw: {sections})")
+
+
+def fit_lines(lines, max_tokens):
+    """
+    Keeps the leading lines that fit in max_tokens, noting how many were left out.
+    """
+    kept = []
+    used = 0
+    for line in lines:
+        cost = estimate_tokens(line) + 1
+        if used + cost > max_tokens:
+            omitted = len(lines) - len(kept)
+            note = f"({omitted} more omitted)"
+            while kept and used + estimate_tokens(note) + 1 > max_tokens:
+                used -= estimate_tokens(kept.pop()) + 1
+                omitted += 1
+                note = f"({omitted} more omitted)"
+            return "\n".join(kept + ([note] if used + estimate_tokens(note) + 1 <= max_tokens else []))
+        kept.append(line)
+        used += cost
+    return "\n".join(kept)
+
+
+def _pairs(history):
+    return [(history[i]["content"], history[i + 1]["content"]) for i in range(len(history) - 1)
+            if history[i]["role"] == "user" and history[i + 1]["role"] == "assistant"]
+
+
+def conversation_context(history, turns=HISTORY_TURNS):
+    """
+    Renders the last question/answer pairs of a conversation verbatim; the unbudgeted form of compress_history.
+
+    Args:
+    history (list): Messages as {"role": ..., "content": ...} dicts, oldest first, without the current question.
+    turns (int): How many of the latest pairs to include.
+
+    Returns:
+    str: "User: ...\\nAssistant: ..." blocks, oldest first.
+    """
+    context = ""
+    for question, answer in _pairs(history)[-turns:] if turns else []:
+        context += f"User: {question}\nAssistant: {answer}\n\n"
+    return context
+
+
+def _shorten(text, max_chars):
+    text = " ".join(text.split())
+    return text if len(text) <= max_chars else text[:max_chars - 1] + "…"
+
+
+def compress_history(history, turns=HISTORY_TURNS, max_tokens=HISTORY_TOKEN_BUDGET):
+    """
+    Renders the conversation context within max_tokens: the latest pair in full (as far as the budget allows), the
+    older ones with their answers cut to SUMMARY_CHARS, dropping the oldest first when they don't fit.
+    """
+    pairs = _pairs(history)[-turns:] if turns else []
+    blocks = []
+    budget = max_tokens
+    for age, (question, answer) in enumerate(reversed(pairs)):
+        limit = budget * 4 // 2 if age == 0 else SUMMARY_CHARS
+        block = f"User: {_shorten(question, limit)}\nAssistant: {_shorten(answer, limit)}\n\n"
+        if estimate_tokens(block) > budget:
+            break
+        blocks.insert(0, block)
+        budget -= estimate_tokens(block)
+    return "".join(blocks)
+
+
+def render_entities(entities, schema="", max_tokens=ENTITY_TOKEN_BUDGET):
+    """
+    Renders retrieved entities compactly, in retrieval order and without duplicates. Tables and columns the schema
+    already describes are only named, on one line; field values are grouped per column.
+
+    Args:
+    entities (list): (id, entity_type, entity_name, entity_description) rows, or None for missing ones.
+    schema (str): The rendered schema included in the same prompt.
+    max_tokens (int): The budget for the rendered entities.
+    """
+    schema_tables = {line.split(" (", 1)[0] for line in schema.splitlines()}
+    relevant = []
+    values = {}
+    other = []
+    for entity in entities:
+        if entity is None:
+            continue
+        _, entity_type, name, description = entity[:4]
+        field = _FIELD_DESCRIPTION.match(description or "")
+        column = _COLUMN_DESCRIPTION.match(description or "")
+        if entity_type == "sqlite field" and field:
+            values.setdefault(f'{field.group(2)}."{field.group(1)}"', []).append(f'"{name}"')
+        elif entity_type == "sqlite table" and name in schema_tables:
+            relevant.append(name)
+        elif entity_type == "sqlite column" and column and column.group(1) in schema_tables:
+            relevant.append(f'{column.group(1)}."{name}"')
+        else:
+            other.append(f"{entity_type} {name}: {description}")
+
+    lines = []
+    if relevant:
+        lines.append("Likely relevant: " + ", ".join(dict.fromkeys(relevant)))
+    for column, names in values.items():
+        lines.append(f"Values of {column}: " + ", ".join(dict.fromkeys(names)))
+    lines.extend(dict.fromkeys(other))
+    return fit_lines(lines, max_tokens)
+
+
+def render_result(result, max_tokens=RESULT_TOKEN_BUDGET):
+    """
+    Renders a query result (or the error text that replaced it) within max_tokens, showing fewer rows until it
+    fits. Small results use whichever of the table and the one-line-per-column form is shorter.
+    """
+    if isinstance(result, str):
+        return fit_lines(result.splitlines(), max_tokens)
+    for max_rows in (20, 10, 5, 0):
+        text = render_result_table(result, max_rows)
+        if max_rows >= result["rows"] and not result["truncated"]:
+            text = min(text, render_query_result(result), key=len)
+        if estimate_tokens(text) <= max_tokens:
+            return text
+    return fit_lines(text.splitlines(), max_tokens)
+
+
+def _unbudgeted_result(result):
+    return result if isinstance(result, str) else render_query_result(result)
+
+
+def build_sql_prompt(question, schema, entities, budget=SQL_PROMPT_BUDGET):
+    """
+    Builds the SQL generation prompt within budget tokens: the schema first, then the retrieved entities.
+
+    Returns:
+    tuple: The prompt and its PromptReport.
+    """
+    report = PromptReport("sql", budget)
+    report.fixed = estimate_tokens(sql_prompt(question, "", ""))
+    remaining = budget - report.fixed
+    schema_text = fit_lines(schema.splitlines(), remaining)
+    report.add("schema", schema, schema_text)
+    remaining -= estimate_tokens(schema_text)
+    entity_text = render_entities(entities, schema_text, min(ENTITY_TOKEN_BUDGET, max(remaining, 0)))
+    report.add("entities", "\n".join(str(info) for info in entities), entity_text)
+    return sql_prompt(question, schema_text, entity_text), report
+
+
+def build_answer_prompt(history, question, sql_query, result, budget=ANSWER_PROMPT_BUDGET):
+    """
+    Builds the final answer prompt within budget tokens: the query result first, then the conversation context.
+
+    Returns:
+    tuple: The prompt and its PromptReport.
+    """
+    report = PromptReport("answer", budget)
+    report.fixed = estimate_tokens(answer_prompt("", question, sql_query, ""))
+    remaining = budget - report.fixed
+    result_text = render_result(result, min(RESULT_TOKEN_BUDGET, max(remaining, 0)))
+    report.add("result", _unbudgeted_result(result), result_text)
+    remaining -= estimate_tokens(result_text)
+    context = compress_history(history, max_tokens=min(HISTORY_TOKEN_BUDGET, max(remaining, 0)))
+    report.add("history", conversation_context(history), context)
+    return answer_prompt(context, question, sql_query, result_text), report
+
+
+def build_questions_prompt(history, question, schema, entities, budget=QUESTIONS_PROMPT_BUDGET):
+    """
+    Builds the suggested questions prompt within budget tokens. Instead of the whole SQL prompt it gets a shorter
+    digest of the schema and entities, then the conversation context.
+
+    Returns:
+    tuple: The prompt and its PromptReport.
+    """
+    report = PromptReport("questions", budget)
+    report.fixed = estimate_tokens(questions_prompt("", question, ""))
+    remaining = budget - report.fixed
+    digest_budget = min(QUESTIONS_CONTEXT_BUDGET, max(remaining, 0))
+    schema_text = fit_lines(schema.splitlines(), digest_budget * 2 // 3)
+    entity_text = render_entities(entities, schema_text, digest_budget - estimate_tokens(schema_text))
+    digest = "\n".join(part for part in (schema_text, entity_text) if part)
+    report.add("sql context", sql_prompt(question, schema, "\n".join(str(info) for info in entities)), digest)
+    remaining -= estimate_tokens(digest)
+    context = compress_history(history, max_tokens=min(HISTORY_TOKEN_BUDGET, max(remaining, 0)))
+    report.add("history", conversation_context(history), context)
+    return questions_prompt(context, question, digest), report
+
+
+def sql_prompt(question, schema, entities):
+    # entities: the rendered entity lines
+    prompt_for_sql_query_request = (
+        f"User has asked the following: {question}, and we have the following database "
+        f"schema:\n")
+    prompt_for_sql_query_request += schema
+    prompt_for_sql_query_request += (
+        "\nAlso we have fetched the following information that may or may not be relevant "
+        "to the user's question:\n")
+
+    if entities:
+        prompt_for_sql_query_request += (entities + "\n")
+
+    prompt_for_sql_query_request += (
+        "Your task is to utilize all the above information that have been given to you, "
+        "to construct a SQLite query that fetches from the database the answer that the "
+        "user requests. Give ONLY the SQL query and nothing else.")
+    return prompt_for_sql_query_request
+
+
+def answer_prompt(context, question, sql_query, result):
+    return f"""
+        Context (if available):
+        {context}
+        User's question: {question}
+        The system run the query: {sql_query}
+        Relevant information:
+        {result}
+        Instructions:
+        If the provided information is relevant and sufficient, give a clear, concise, and direct answer to the user's question.
+        If the information is irrelevant or insufficient, politely inform the user that you don't have enough information to provide an answer.
+        Do not refer to the query or the information retrieval process in your response.
+        For greetings or trivial questions that don't require additional information, respond using your existing knowledge and without refering to context, relevant information etc.
+        """
+
+
+def questions_prompt(context, question, sql_prompt):
+    return f"""
+                # Task Description:
+                # Generate a list of 3 questions. These questions should be directly answerable based on the provided context and should help the user explore potential inquiries related to the given information.
+
+                # Provided Information:
+                # Context: {context}
+                # User's Initial Question: {question}
+                # Additional SQL Query Context: {sql_prompt}
+
+                # Instructions:
+                # Utilize all the provided information to formulate three specific questions. These questions should be crafted in a way that they can be definitively answered using the given context and have a similar sqlite query like the previous to ensure query execution.
+                # Output the questions as a numbered list and ensure no additional text is included in the response.
+                # Do NOT refer to the query or to technical jargon like sql tables in your questions.
+
+                # Example of expected output:
+                # 1. Question A
+                # 2. Question B
+                # 3. Question C
+
+                # Note: Replace the example questions with your generated questions based on the actual provided data.
+
+                # End of instructions.
+                """
@@ -0,0 +1,482 @@
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from services.chat import llm
+from services.chat.prompts import compress_history, build_sql_prompt, build_answer_prompt, build_questions_prompt
+from services.chat.sql_cache import SemanticSQLCache, is_follow_up
+from services.chat.stages import Stage, run_stages, submit_stages
+from services.data.oper import fetch_entities_by_ids, database_version
+from services.data.result_cache import execute_cached_query
+from services.data.safe_query import render_query_result
+from services.data.schema import get_schema_catalogue, render_schema, schema_fingerprint
+from services.data.search import quota_search_batch
+from services.data.store import IndexingService
+from services.embeddings.embed import generate_embeddings_batch, warm_up, DEFAULT_MODEL_NAME
+from services.monitoring import tracing
+
+INDEX_PATH = "vector_index.bin"
+ENTITIES_DB = "entities.db"
+DATA_DB = "data_store"
+
+# Turns preparing at once; the rest wait their turn
+MAX_CONCURRENCY = 8
+MAX_SESSIONS = 1000
+# Messages kept per session
+HISTORY_SIZE = 20
+# Embedding and kNN requests arriving within BATCH_WINDOW seconds of each other share one call
+BATCH_SIZE = 32
+BATCH_WINDOW = 0.005
+ENTITIES_PER_QUESTION = 20
+
+
+def _build_prompt(reports, stage, build, *args):
+    with tracing.span(f"prompt.{stage}") as span:
+        prompt, report = build(*args)
+        span.set(prompt_tokens=report.tokens, tokens_saved=report.saved)
+    reports.append(report)
+    return prompt
+
+
+def file_version(path):
+    """
+    Changes whenever the file is rewritten; used to reload resources built from it.
+    """
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Batcher:
+    """
+    Collects the items submitted within window seconds of each other, up to max_batch, and passes them to func in
+    one call, so concurrent turns share a model or index call. func takes a list of items and returns their results
+    in the same order; it runs in executor. Must be used from a single event loop.
+    """
+
+    def __init__(self, name, func, executor, max_batch=BATCH_SIZE, window=BATCH_WINDOW):
+        self.name = name
+        self.func = func
+        self.executor = executor
+        self.max_batch = max_batch
+        self.window = window
+        self.batches = 0
+        self.items = 0
+        self._pending = []
+        self._timer = None
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self._call, batch)
+        except Exception as e:
+            results = [e] * len(batch)
+            failed = True
+        else:
+            failed = False
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if failed:
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _call(self, batch):
+        with tracing.span(f"batch.{self.name}", items=len(batch)):
+            return self.func([item for item, _ in batch])
+
+
+class ChatResources:
+    """
+    The index, schema and SQL cache a turn reads. refresh() reloads whichever of them changed on
+    disk, so a rebuilt index or reloaded database is picked up without restarting the service.
+    """
+
+    def __init__(self, index_path=INDEX_PATH, entities_db=ENTITIES_DB, data_db=DATA_DB, sql_cache=None):
+        self.index_path = index_path
+        self.entities_db = entities_db
+        self.data_db = data_db
+        self.sql_cache = sql_cache or SemanticSQLCache("sql_cache.db")
+        self.index = None
+        self.schema = None
+        self.schema_version = None
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            version = file_version(self.index_path)
+            if self._versions.get("index") != version:
+                index = IndexingService(model_name=DEFAULT_MODEL_NAME)
+                index.load_index(self.index_path)
+                self.index = index
+                self._versions["index"] = version
+
+            version = database_version(self.data_db)
+            if self._versions.get("schema") != version:
+                catalogue = get_schema_catalogue(self.data_db)
+                self.schema, self.schema_version = render_schema(catalogue), schema_fingerprint(catalogue)
+                self._versions["schema"] = version
+        return self
+
+
+class ChatTurn:
+    """
+    A prepared turn: everything up to the final answer, whose prompt is in answer_prompt. The suggested questions
+    keep generating in the background in questions_future. prompt_reports holds the PromptReport of every prompt
+    built so far.
+    """
+
+    def __init__(self, turn_id, session_id, question, context, sql_prompt, sql_query, result, answer_prompt,
+                 questions_future, prompt_reports):
+        self.turn_id = turn_id
+        self.session_id = session_id
+        self.question = question
+        self.context = context
+        self.sql_prompt = sql_prompt
+        self.sql_query = sql_query
+        self.result = result
+        self.answer_prompt = answer_prompt
+        self.questions_future = questions_future
+        self.prompt_reports = prompt_reports
+
+    def suggested_questions(self, timeout=None):
+        return self.questions_future.result(timeout)["questions"]
+
+
+class ChatService:
+    """
+    Answers questions without a UI: retrieval, SQL generation, execution and the final answer, with per-session
+    history. At most max_concurrency turns prepare at once, and the embeddings and kNN queries of concurrent turns
+    are batched into shared calls.
+
+    The service runs its own event loop in a background thread. Its coroutines must run on that loop: await them
+    from code already running there (e.g. the HTTP handler), or call them through run() from any other thread.
+    """
+
+    def __init__(self, client, resources=None, max_concurrency=MAX_CONCURRENCY, max_sessions=MAX_SESSIONS,
+                 history_size=HISTORY_SIZE, batch_size=BATCH_SIZE, batch_window=BATCH_WINDOW):
+        self.client = client
+        self.resources = resources or ChatResources()
+        self.max_concurrency = max_concurrency
+        self.max_sessions = max_sessions
+        self.history_size = history_size
+        self._sessions = OrderedDict()
+        self._sessions_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._loop = None
+        self._semaphore = None
+
+        # Separate pools, so a stage blocked on a batch can never starve the pool the batch runs in, nor a stage
+        # graph the pool its stages run in
+        self._graphs = ThreadPoolExecutor(max_workers=2 * max_concurrency, thread_name_prefix="chat-graph")
+        self._stages = ThreadPoolExecutor(max_workers=4 * max_concurrency, thread_name_prefix="chat-stage")
+        self._batches = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chat-batch")
+        self.embeddings = Batcher("embeddings", generate_embeddings_batch, self._batches, batch_size, batch_window)
+        self.searches = Batcher("searches", self._search_batch, self._batches, batch_size, batch_window)
+
+    def start(self):
+        """
+        Loads the embedding model and resources and starts the event loop; safe to call more than once.
+        """
+        with self._start_lock:
+            if self._loop is None:
+                warm_up()
+                self.resources.refresh()
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="chat-service", daemon=True).start()
+                self._semaphore = asyncio.run_coroutine_threadsafe(self._create_semaphore(), loop).result()
+                self._loop = loop
+        return self
+
+    async def _create_semaphore(self):
+        return asyncio.Semaphore(self.max_concurrency)
+
+    def run(self, coro, timeout=None):
+        """
+        Runs a coroutine of the service from another thread and returns its result.
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def _search_batch(self, items):
+        resources = self.resources
+        embeddings = [embedding for embedding, _ in items]
+        texts = [text for _, text in items]
+        return quota_search_batch(resources.index, embeddings, texts, resources.entities_db,
+                                  k=ENTITIES_PER_QUESTION)
+
+    def history(self, session_id):
+        with self._sessions_lock:
+            return list(self._sessions.get(session_id, ()))
+
+    def record(self, turn, answer):
+        """
+        Adds a finished turn to its session's history.
+        """
+        with self._sessions_lock:
+            messages = self._sessions.pop(turn.session_id, [])
+            messages.append({"role": "user", "content": turn.question})
+            messages.append({"role": "assistant", "content": answer})
+            self._sessions[turn.session_id] = messages[-self.history_size:]
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    async def prepare_turn(self, session_id, question):
+        """
+        Runs a turn up to the final answer: retrieval, SQL generation and execution.
+
+        Returns:
+        ChatTurn: The prepared turn; stream its answer with stream_answer() or get it with answer().
+        """
+        async with self._semaphore:
+            return await self._prepare_turn(session_id, question)
+
+    async def _prepare_turn(self, session_id, question):
+        turn_id = uuid.uuid4().hex
+        with tracing.turn(turn_id), tracing.span("turn.prepare", session=session_id):
+            return await self._run_turn(turn_id, session_id, question)
+
+    def _in_context(self, func, *args):
+        # Pool threads don't inherit the caller's context, which carries the turn id for tracing
+        return asyncio.get_running_loop().run_in_executor(self._graphs, contextvars.copy_context().run, func, *args)
+
+    async def _run_turn(self, turn_id, session_id, question):
+        loop = asyncio.get_running_loop()
+        resources = await loop.run_in_executor(self._stages, self.resources.refresh)
+        schema, schema_version, sql_cache = resources.schema, resources.schema_version, resources.sql_cache
+        history = self.history(session_id)
+        context = compress_history(history)
+        reports = []
+
+        def batched(batcher, item):
+            # Stages run in pool threads; the batch itself is collected on the service loop
+            return asyncio.run_coroutine_threadsafe(batcher.submit(item), loop).result()
+
+        def retrieve_entities(embedding):
+            # Tables and columns get reserved places; the rest are field values from the hybrid search, where the
+            # lexical side finds exact names, codes and dates the embedding misses
+            entity_ids = batched(self.searches, (embedding, question))
+            return fetch_entities_by_ids(resources.entities_db, entity_ids)
+
+        def run_sql(sql_query, cache_key, cached_sql):
+            # The query and any error go on the trace
+            with tracing.span("sql.run", sql=sql_query, cached=cached_sql is not None) as span:
+                try:
+                    result = execute_cached_query(resources.data_db, sql_query)
+                except Exception as e:
+                    span.set(error=str(e))
+                    return "Query failed to execute."
+            if cached_sql is None and cache_key is not None:
+                # Only queries that ran successfully are worth reusing
+                sql_cache.store(cache_key, question, sql_query, schema_version)
+            return result
+
+        # The SQL cache is keyed on the question alone, as with the conversation in the key nothing asked after the
+        # first turn could hit; follow-ups that only make sense with the conversation are neither looked up nor stored
+        cacheable = not (history and is_follow_up(question))
+        if context and cacheable:
+            cache_key = Stage("cache_key", lambda: batched(self.embeddings, question), timeout=10, retries=1,
+                              default=None)
+        else:
+            cache_key = Stage("cache_key", lambda embedding: embedding if cacheable else None, requires=["embedding"])
+
+        retrieval = await self._in_context(run_stages, [
+            Stage("embedding", lambda: batched(self.embeddings, f"{context} {question}" if context else question),
+                  timeout=10, retries=1),
+            cache_key,
+            Stage("entities", retrieve_entities, requires=["embedding"], timeout=10, retries=1),
+            Stage("cached_sql", lambda cache_key: None if cache_key is None else sql_cache.lookup(
+                cache_key, schema_version, question), requires=["cache_key"], default=None),
+            Stage("sql_prompt", lambda entities: _build_prompt(reports, "sql", build_sql_prompt, question, schema,
+                                                               entities), requires=["entities"])
+        ], self._stages)
+        prompt_for_sql = retrieval["sql_prompt"]
+        cached_sql = retrieval["cached_sql"]
+
+        # The suggested questions only depend on the retrieval, so they are generated in the background while the
+        # SQL query is generated and run and the final answer streams in
+        prompt_for_questions = _build_prompt(reports, "questions", build_questions_prompt, history, question, schema,
+                                             retrieval["entities"])
+        questions_future = submit_stages([
+            Stage("questions", lambda: llm.request_to_llm(self.client, prompt_for_questions),
+                  timeout=llm.LLM_TIMEOUT, retries=llm.LLM_RETRIES, default="")
+        ], self._stages)
+
+        def sql_stages(cached_sql):
+            return [
+                Stage("sql_query", lambda: cached_sql or llm.request_to_llm(self.client, prompt_for_sql),
+                      timeout=llm.LLM_TIMEOUT, retries=llm.LLM_RETRIES),
+                Stage("result", lambda sql_query: run_sql(sql_query, retrieval["cache_key"], cached_sql),
+                      requires=["sql_query"])
+            ]
+
+        results = await self._in_context(run_stages, sql_stages(cached_sql), self._stages)
+        if cached_sql is not None and isinstance(results["result"], str):
+            # The cached query no longer runs (e.g. the data outgrew its scan budget), so it is dropped and the SQL
+            # generated anew, which also stores the new query if it runs
+            sql_cache.invalidate(cached_sql, schema_version)
+            results = await self._in_context(run_stages, sql_stages(None), self._stages)
+
+        result = results["result"]
+        prompt_for_answer = _build_prompt(reports, "answer", build_answer_prompt, history, question,
+                                          results["sql_query"], result)
+        return ChatTurn(turn_id, session_id, question, context, prompt_for_sql, results["sql_query"],
+                        result if isinstance(result, str) else render_query_result(result), prompt_for_answer,
+                        questions_future, reports)
+
+    def stream_answer(self, turn):
+        """
+        Opens a stream of the turn's answer; iterate it (or pass it to st.write_stream) for the text.
+        """
+        return llm.TextStream(self.client, turn.answer_prompt)
+
+    def answer(self, turn):
+        """
+        Gets the turn's answer in one blocking call, with the usual retries.
+        """
+        return run_stages([
+            Stage("final_answer", lambda: llm.request_to_llm(self.client, turn.answer_prompt),
+                  timeout=llm.LLM_TIMEOUT, retries=llm.LLM_RETRIES)
+        ], self._stages)["final_answer"]
+
+    async def ask(self, session_id, question):
+        """
+        Runs a whole turn and records it in the session's history.
+
+        Returns:
+        dict: The answer, the SQL query and its result, the suggested questions and the token reports of the
+        prompts.
+        """
+        async with self._semaphore:
+            turn = await self._prepare_turn(session_id, question)
+            with tracing.turn(turn.turn_id):
+                answer = await self._in_context(self.answer, turn)
+        questions = (await asyncio.wrap_future(turn.questions_future))["questions"]
+        self.record(turn, answer)
+        return {"session_id": session_id, "answer": answer, "sql_query": turn.sql_query, "result": turn.result,
+                "questions": questions, "prompts": [report.to_dict() for report in turn.prompt_reports]}
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        """
+        Serves the HTTP API until cancelled:
+
+        POST /ask with {"question": ..., "session_id": ...} runs a turn; a session id is created if none is given.
+        GET /sessions/<id> returns a session's history.
+        GET /health returns {"status": "ok"}.
+        GET /metrics returns the tracing metrics in the Prometheus text format, when tracing is on.
+        """
+        server = await asyncio.start_server(self._handle, host, port)
+        print(f"Chat service listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, payload = await self._route(request_line, body)
+        except Exception as e:
+            status, payload = 500, {"error": str(e)}
+
+        if isinstance(payload, str):
+            data, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            data, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+        writer.write(f"HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, request_line, body):
+        if len(request_line) < 2:
+            return 400, {"error": "Malformed request"}
+        method, path = request_line[0], request_line[1].split("?")[0]
+
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/metrics":
+            tracer = tracing.get_tracer()
+            if tracer is None:
+                return 404, {"error": "Tracing is off"}
+            return 200, tracer.prometheus_text()
+        if method == "GET" and path.startswith("/sessions/"):
+            session_id = path[len("/sessions/"):]
+            return 200, {"session_id": session_id, "messages": self.history(session_id)}
+        if method == "POST" and path == "/ask":
+            try:
+                request = json.loads(body or b"{}")
+            except ValueError:
+                return 400, {"error": "Body must be JSON"}
+            if not isinstance(request, dict) or not request.get("question"):
+                return 400, {"error": "'question' is required"}
+            session_id = request.get("session_id") or uuid.uuid4().hex
+            return 200, await self.ask(session_id, request["question"])
+        return 404, {"error": f"No route for {method} {path}"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the chat service over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY)
+    parser.add_argument("--local", action="store_true", help="Answer with the offline LocalBedrockClient")
+    parser.add_argument("--trace", nargs="?", const="", metavar="PATH",
+                        help="Trace turns and serve /metrics; spans are also appended to PATH as JSON lines if given")
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        tracing.enable(args.trace or None)
+
+    if args.local:
+        from services.chat.local_bedrock import LocalBedrockClient
+        client = LocalBedrockClient()
+    else:
+        from dotenv import load_dotenv
+        load_dotenv()
+        client = llm.create_bedrock_client()
+
+    service = ChatService(client, max_concurrency=args.max_concurrency)
+    try:
+        service.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
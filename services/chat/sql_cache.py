@@ -0,0 +1,179 @@
+import re
+import threading
+import time
+
+import numpy as np
+
+from services.data.oper import get_connection
+from services.monitoring import tracing
+
+SIMILARITY_THRESHOLD = 0.95
+MAX_ENTRIES = 500
+TTL = 7 * 24 * 3600  # seconds
+
+# Numbers, quoted values and date words; a cached query is only reused for a question with the same ones, since
+# embeddings of questions that differ only in a date or a number can be nearly identical
+_LITERAL = re.compile(r"\d+|(?<!\w)'[^']*'(?!\w)|\"[^\"]*\"|"
+                      r"\b(?:today|yesterday|tomorrow|last|this|next|previous|current|"
+                      r"monday|tuesday|wednesday|thursday|friday|saturday|sunday|"
+                      r"january|february|march|april|may|june|july|august|september|october|november|december|"
+                      r"q[1-4])\b", re.IGNORECASE)
+
+# Questions that lean on the conversation for their meaning ("and last month?", "what about those?")
+_FOLLOW_UP = re.compile(r"^\W*(?:and|but|also|or|then|what about|how about)\b|\b(?:it|its|that|those|these|them|they|"
+                        r"there|same|previous one|above|instead|else|this one)\b", re.IGNORECASE)
+
+
+def question_literals(question):
+    """
+    The numbers, quoted values and date words of a question, which must match for a cached query to be reused.
+    """
+    return tuple(sorted(match.lower() for match in _LITERAL.findall(question or "")))
+
+
+def is_follow_up(question):
+    """
+    Whether a question probably depends on the previous turns, so its SQL can't be cached on the question alone.
+    """
+    return bool(_FOLLOW_UP.search(question))
+
+
+class SemanticSQLCache:
+    """
+    Caches the SQL generated for a question, keyed on the question's embedding.
+
+    A lookup returns the SQL of the most similar cached question when the cosine similarity reaches the threshold,
+    the entry was stored for the same schema fingerprint and, when the question is given, both questions have the
+    same numbers, quoted values and date words. Only queries that executed successfully should be
+    stored. Entries expire after ttl seconds, and the least recently used ones are evicted beyond max_entries.
+    Entries and hit/miss counts live in a small SQLite database.
+    """
+
+    def __init__(self, db_path="sql_cache.db", threshold=SIMILARITY_THRESHOLD, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.db_path = db_path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # In-memory copy of the entries of one schema: (schema, ids, normalized embedding matrix, sql list,
+        # question literals list, creation times)
+        self._entries = None
+
+        conn = get_connection(db_path)
+        conn.execute("""CREATE TABLE IF NOT EXISTS sql_cache (
+            id INTEGER PRIMARY KEY,
+            schema TEXT NOT NULL,
+            question TEXT,
+            sql TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            created REAL NOT NULL,
+            last_used REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0)""")
+        conn.execute("CREATE TABLE IF NOT EXISTS sql_cache_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.commit()
+
+    def _load(self, schema):
+        if self._entries is not None and self._entries[0] == schema:
+            return self._entries
+        rows = get_connection(self.db_path).execute(
+            "SELECT id, embedding, sql, question, created FROM sql_cache WHERE schema = ? AND created >= ?",
+            (schema, time.time() - self.ttl)).fetchall()
+        if rows:
+            matrix = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+        self._entries = (schema, [row[0] for row in rows], matrix, [row[2] for row in rows],
+                         [question_literals(row[3]) for row in rows], np.array([row[4] for row in rows]))
+        return self._entries
+
+    def _count(self, conn, name):
+        conn.execute("INSERT INTO sql_cache_stats (name, value) VALUES (?, 1) "
+                     "ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    @staticmethod
+    def _normalize(embedding):
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def lookup(self, embedding, schema, question=None):
+        """
+        Returns the cached SQL for the most similar question, or None on a miss.
+
+        Args:
+        embedding (np.ndarray): The embedding of the question alone.
+        schema (str): The current schema fingerprint.
+        question (str): The question text; only entries with the same question_literals can match.
+        """
+        with tracing.span("sql_cache.lookup") as span:
+            sql = self._lookup(self._normalize(embedding), schema, question)
+            span.set(cache_hit=sql is not None)
+        return sql
+
+    def _lookup(self, embedding, schema, question):
+        with self._lock:
+            _, ids, matrix, queries, literals, created = self._load(schema)
+            conn = get_connection(self.db_path)
+            best = None
+            if ids and matrix.shape[1] == embedding.shape[0]:
+                similarities = matrix @ embedding
+                # The in-memory copy outlives the ttl of its entries when nothing is stored for a while
+                similarities = np.where(created >= time.time() - self.ttl, similarities, -np.inf)
+                if question is not None:
+                    wanted = question_literals(question)
+                    similarities = np.where([entry == wanted for entry in literals], similarities, -np.inf)
+                position = int(np.argmax(similarities))
+                if similarities[position] >= self.threshold:
+                    best = position
+            if best is None:
+                self._count(conn, "misses")
+                conn.commit()
+                return None
+            conn.execute("UPDATE sql_cache SET last_used = ?, hits = hits + 1 WHERE id = ?",
+                         (time.time(), ids[best]))
+            self._count(conn, "hits")
+            conn.commit()
+            return queries[best]
+
+    def store(self, embedding, question, sql, schema):
+        """
+        Stores a validated query, then drops expired entries and evicts the least recently used beyond max_entries.
+        """
+        embedding = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            conn = get_connection(self.db_path)
+            conn.execute("INSERT INTO sql_cache (schema, question, sql, embedding, created, last_used) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (schema, question, sql, embedding.tobytes(), now, now))
+            conn.execute("DELETE FROM sql_cache WHERE created < ?", (now - self.ttl,))
+            conn.execute("DELETE FROM sql_cache WHERE id NOT IN "
+                         "(SELECT id FROM sql_cache ORDER BY last_used DESC LIMIT ?)", (self.max_entries,))
+            conn.commit()
+            self._entries = None
+
+    def invalidate(self, sql, schema):
+        """
+        Removes the entries with the given SQL, e.g. a cached query that no longer executes.
+        """
+        with self._lock:
+            conn = get_connection(self.db_path)
+            conn.execute("DELETE FROM sql_cache WHERE schema = ? AND sql = ?", (schema, sql))
+            conn.commit()
+            self._entries = None
+
+    def stats(self):
+        """
+        Returns the number of entries and the hit and miss counts.
+        """
+        conn = get_connection(self.db_path)
+        stats = dict(conn.execute("SELECT name, value FROM sql_cache_stats").fetchall())
+        entries, = conn.execute("SELECT COUNT(*) FROM sql_cache").fetchone()
+        return {"entries": entries, "hits": stats.get("hits", 0), "misses": stats.get("misses", 0)}
+
+    def clear(self):
+        with self._lock:
+            conn = get_connection(self.db_path)
+            conn.execute("DELETE FROM sql_cache")
+            conn.execute("DELETE FROM sql_cache_stats")
+            conn.commit()
+            self._entries = None
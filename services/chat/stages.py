@@ -0,0 +1,161 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from services.monitoring import tracing
+
+# Shared pool for running the stages of chat turns
+MAX_WORKERS = 8
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_NO_DEFAULT = object()
+
+
+class StageError(Exception):
+    """
+    Raised when a stage fails or times out after all of its retries and has no default.
+    """
+
+    def __init__(self, stage_name, cause):
+        super().__init__(f"Stage '{stage_name}' failed: {cause}")
+        self.stage_name = stage_name
+        self.cause = cause
+
+
+class Stage:
+    """
+    A unit of work in a chat turn.
+
+    name: the key the stage's result is stored under.
+    func: called with the results of the stages in requires as keyword arguments.
+    requires: names of the stages that must finish first.
+    timeout: seconds a single attempt may take, or None for no limit.
+    retries: how many times to retry after a failure or timeout.
+    backoff: seconds to wait before the first retry after a failure, doubled on each following retry.
+    default: result to use when the stage ultimately fails; without it the failure aborts the turn.
+    """
+
+    def __init__(self, name, func, requires=(), timeout=None, retries=0, backoff=0.5, default=_NO_DEFAULT):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.default = default
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="chat-stage")
+    return _executor
+
+
+def _attempt(stage, kwargs, attempt):
+    if attempt > 1 and stage.backoff:
+        time.sleep(stage.backoff * 2 ** (attempt - 2))
+    with tracing.span(f"stage.{stage.name}", attempt=attempt):
+        return stage.func(**kwargs)
+
+
+def run_stages(stages, executor=None):
+    """
+    Runs stages as soon as the stages they require have finished, so independent stages run concurrently.
+
+    Args:
+    stages (list): The Stage objects of the turn.
+    executor (Executor): The pool to run stages in; defaults to the shared pool.
+
+    Returns:
+    dict: The result of every stage keyed by stage name.
+
+    Raises:
+    StageError: If a stage without a default fails or times out after its retries.
+    ValueError: If a stage requires a stage that is not part of the graph.
+    """
+    executor = executor or get_executor()
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        missing = set(stage.requires) - names
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' requires unknown stages: {sorted(missing)}")
+
+    results = {}
+    pending = list(stages)
+    running = {}
+    attempts = {}
+
+    def submit(stage):
+        attempts[stage.name] = attempts.get(stage.name, 0) + 1
+        kwargs = {name: results[name] for name in stage.requires}
+        # Run in a copy of the caller's context, so spans inside the stage keep the turn they belong to
+        future = executor.submit(contextvars.copy_context().run, _attempt, stage, kwargs, attempts[stage.name])
+        deadline = time.monotonic() + stage.timeout if stage.timeout else None
+        running[future] = (stage, deadline)
+
+    def fail(stage, cause):
+        if attempts[stage.name] <= stage.retries:
+            submit(stage)
+        elif stage.default is not _NO_DEFAULT:
+            print(f"Stage '{stage.name}' failed, using its default: {cause}")
+            results[stage.name] = stage.default
+        else:
+            raise StageError(stage.name, cause)
+
+    while pending or running:
+        for stage in list(pending):
+            if all(name in results for name in stage.requires):
+                pending.remove(stage)
+                submit(stage)
+
+        if not running:
+            raise ValueError(f"Stages have circular requirements: {[stage.name for stage in pending]}")
+
+        deadlines = [deadline for _, deadline in running.values() if deadline is not None]
+        timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            stage, _ = running.pop(future)
+            try:
+                results[stage.name] = future.result()
+            except Exception as e:
+                fail(stage, e)
+
+        now = time.monotonic()
+        for future, (stage, deadline) in list(running.items()):
+            if deadline is not None and now >= deadline:
+                # The attempt keeps running in its thread, but its result is no longer waited for
+                del running[future]
+                future.cancel()
+                fail(stage, TimeoutError(f"timed out after {stage.timeout}s"))
+
+    return results
+
+
+def submit_stages(stages, executor=None):
+    """
+    Runs stages in the background and returns a Future for their results, so the caller can carry on (e.g. stream
+    an answer) while they finish.
+
+    The graph is coordinated from its own thread rather than a pool worker, so waiting on it can't starve the pool.
+    """
+    future = Future()
+
+    def coordinate():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(run_stages(stages, executor))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(coordinate,), name="chat-stage-graph",
+                     daemon=True).start()
+    return future
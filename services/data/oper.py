@@ -1,6 +1,81 @@
+import os
+import threading
+
 import pandas as pd
 import sqlite3
 
+from services.monitoring import tracing
+
+# Columns of the entities table that describe an entity
+ENTITY_FIELDS = "id, entity_type, entity_name, entity_description"
+
+# SQLite has a limit on bound parameters per statement, so long IN (...) lists are split
+MAX_QUERY_PARAMETERS = 900
+
+# Connections are cached per thread, as sqlite3 connections must not be shared across threads by default
+_local = threading.local()
+
+
+def _connect(db_path, read_only):
+    if read_only:
+        conn = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True, cached_statements=256)
+    else:
+        conn = sqlite3.connect(db_path, cached_statements=256)
+        # WAL lets readers keep working while the pipeline writes
+        conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def get_connection(db_path, read_only=False):
+    """
+    Returns this thread's cached connection to the given SQLite database, opening it on first use.
+
+    Reusing the connection also reuses its prepared statement cache, so repeated queries are not re-parsed.
+
+    Args:
+    db_path (str): The path to the SQLite database file.
+    read_only (bool): Whether to open the database through a read-only URI.
+
+    Returns:
+    sqlite3.Connection: The cached connection.
+    """
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    key = (os.path.abspath(db_path), read_only)
+    conn = connections.get(key)
+    if conn is None:
+        conn = connections[key] = _connect(db_path, read_only)
+    return conn
+
+
+def database_version(db_path):
+    """
+    Returns a value that changes whenever the database's schema or data changes.
+
+    It combines PRAGMA schema_version with the modification time and size of the database file and its WAL file.
+    PRAGMA data_version is only comparable within a single connection, so the file signature stands in for it
+    across threads and processes.
+    """
+    conn = get_connection(db_path, read_only=True)
+    schema_version, = conn.execute("PRAGMA schema_version").fetchone()
+    signature = [schema_version]
+    for path in (db_path, db_path + "-wal"):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signature.extend([stat.st_mtime_ns, stat.st_size])
+    return tuple(signature)
+
+
+def close_connections():
+    """
+    Closes every connection cached by the current thread.
+    """
+    connections = getattr(_local, "connections", {})
+    for conn in connections.values():
+        conn.close()
+    connections.clear()
+
 
 def read_csv_to_dataframe(file_path):
     """
@@ -32,12 +107,13 @@ def read_table_to_dataframe(table_name, db_file="data_store"):
     Returns:
     pd.DataFrame: A DataFrame containing the data from the specified table, or None if an error occurs.
     """
-    # Establish a connection to the database
     try:
-        with sqlite3.connect(db_file) as conn:
+        conn = get_connection(db_file, read_only=True)
+        with tracing.span("db.read_table", table=table_name) as span:
             # Use pandas to read the table into a DataFrame
             df = pd.read_sql(f"SELECT * FROM {table_name}", conn)
-            return df
+            span.set(rows=len(df))
+        return df
     except Exception as e:
         print(f"An error occurred while reading the table: {e}")
         return None
@@ -52,27 +128,41 @@ def fetch_entity_by_id(database_path, entity_id):
     entity_id (int): The ID of the entity to retrieve.
 
     Returns:
-    tuple: The row corresponding to the entity_id or None if no such entity exists.
+    tuple: The (id, entity_type, entity_name, entity_description) row or None if no such entity exists.
     """
-    # Connect to the SQLite database
-    conn = sqlite3.connect(database_path)
-    cursor = conn.cursor()
-
     try:
-        # Prepare the SELECT query
-        query = "SELECT * FROM entities WHERE id = ?"
-        # Execute the query with the provided entity_id
-        cursor.execute(query, (entity_id,))
-        # Fetch the result
-        result = cursor.fetchone()
-        return result
+        conn = get_connection(database_path, read_only=True)
+        return conn.execute(f"SELECT {ENTITY_FIELDS} FROM entities WHERE id = ?", (entity_id,)).fetchone()
     except sqlite3.Error as e:
         print(f"An error occurred: {e}")
         return None
-    finally:
-        # Close the cursor and connection
-        cursor.close()
-        conn.close()
+
+
+def fetch_entities_by_ids(database_path, entity_ids):
+    """
+    Fetch several entities at once, e.g. all the kNN hits of a query, with one IN (...) query.
+
+    Args:
+    database_path (str): The path to the SQLite database file.
+    entity_ids (list): The IDs of the entities to retrieve, in ranking order.
+
+    Returns:
+    list: The rows in the same order as entity_ids, with None for IDs that don't exist.
+    """
+    entity_ids = [int(entity_id) for entity_id in entity_ids]
+    rows = {}
+    with tracing.span("db.fetch_entities", ids=len(entity_ids)) as span:
+        try:
+            conn = get_connection(database_path, read_only=True)
+            for start in range(0, len(entity_ids), MAX_QUERY_PARAMETERS):
+                chunk = entity_ids[start:start + MAX_QUERY_PARAMETERS]
+                placeholders = ", ".join("?" * len(chunk))
+                for row in conn.execute(f"SELECT {ENTITY_FIELDS} FROM entities WHERE id IN ({placeholders})", chunk):
+                    rows[row[0]] = row
+        except sqlite3.Error as e:
+            print(f"An error occurred: {e}")
+        span.set(rows=len(rows))
+    return [rows.get(entity_id) for entity_id in entity_ids]
 
 
 def summarize_schema(database_path):
@@ -85,30 +175,29 @@ def summarize_schema(database_path):
     Returns:
     str: A string summarizing the schema of the database.
     """
-    # Connect to the SQLite database
-    conn = sqlite3.connect(database_path)
+    conn = get_connection(database_path, read_only=True)
     cursor = conn.cursor()
 
-    # Get the list of tables in the database
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    tables = cursor.fetchall()
+    with tracing.span("db.summarize_schema") as span:
+        # Get the list of tables in the database
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        tables = cursor.fetchall()
 
-    # Initialize an empty list to store schema descriptions for each table
-    schema_descriptions = []
+        # Initialize an empty list to store schema descriptions for each table
+        schema_descriptions = []
 
-    # Iterate over each table and get column details
-    for table_name, in tables:
-        cursor.execute(f"PRAGMA table_info({table_name})")
-        columns = cursor.fetchall()
+        # Iterate over each table and get column details
+        for table_name, in tables:
+            cursor.execute(f"PRAGMA table_info({table_name})")
+            columns = cursor.fetchall()
 
-        # Format the column details into a string
-        column_descriptions = ", ".join(f"{col[1]}:{col[2]}" for col in columns)
-        table_description = f"{table_name} has columns ({column_descriptions})"
-        schema_descriptions.append(table_description)
+            # Format the column details into a string
+            column_descriptions = ", ".join(f"{col[1]}:{col[2]}" for col in columns)
+            table_description = f"{table_name} has columns ({column_descriptions})"
+            schema_descriptions.append(table_description)
 
-    # Close the cursor and connection
-    cursor.close()
-    conn.close()
+        cursor.close()
+        span.set(tables=len(tables))
 
     # Join all table descriptions into a single string
     schema_summary = "\n".join(schema_descriptions)
@@ -129,32 +218,31 @@ def execute_sqlite_query(db_path, query):
     Raises:
     Exception: If an error occurs during database connection or query execution.
     """
+    conn = None
     try:
-        # Connect to the SQLite database
-        conn = sqlite3.connect(db_path)
+        conn = get_connection(db_path)
 
         # Create a cursor object using the cursor() method
         cursor = conn.cursor()
 
-        # Executing the query
-        cursor.execute(query)
+        with tracing.span("db.execute_query") as span:
+            # Executing the query
+            cursor.execute(query)
 
-        # Fetch all rows from the last executed statement using fetchall()
-        results = cursor.fetchall()
+            # Fetch all rows from the last executed statement using fetchall()
+            results = cursor.fetchall()
+            span.set(rows=len(results))
 
         # Committing the changes (important if the query modifies the database)
         conn.commit()
 
-        # Closing the connection
-        conn.close()
+        cursor.close()
 
         return results
 
     except sqlite3.Error as e:
+        # Don't leave a half-finished transaction on the cached connection
+        if conn:
+            conn.rollback()
         # Handle the SQLite error
         raise Exception(f"An error occurred while executing the SQL query: {e}")
-
-    finally:
-        # Ensure the connection is closed even if an error occurs
-        if conn:
-            conn.close()
@@ -0,0 +1,115 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from services.data.oper import database_version
+from services.data.safe_query import clean_query, execute_safe_query
+from services.monitoring import tracing
+
+# Memory bound of the default cache, in (approximate) bytes of result values
+MAX_BYTES = 64 * 1024 * 1024
+
+_TOKENS = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|(--[^\n]*|/\*.*?\*/)|([^'\"\-/]+|[\-/])", re.DOTALL)
+
+
+def normalize_sql(query):
+    """
+    Normalizes a query for use as a cache key: strips code fences, comments and trailing semicolons, collapses
+    whitespace and lowercases everything outside quoted strings and identifiers.
+    """
+    parts = []
+    text_run = ""
+    for quoted, comment, text in _TOKENS.findall(clean_query(query)):
+        if quoted:
+            parts.append(re.sub(r"\s+", " ", text_run))
+            parts.append(quoted)
+            text_run = ""
+        else:
+            text_run += text.lower() if text else " "
+    parts.append(re.sub(r"\s+", " ", text_run))
+    return "".join(parts).strip()
+
+
+def _result_size(result):
+    return sum(len(str(value)) for values in result["data"] for value in values) + 100
+
+
+class QueryResultCache:
+    """
+    LRU cache of query results keyed on the database and normalized SQL. Entries are only returned while the
+    database version they were computed at is current, so reloading the data invalidates them.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, result):
+        size = _result_size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[2]
+            self._entries[key] = (version, result, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+
+_default_cache = QueryResultCache()
+
+
+def get_result_cache():
+    return _default_cache
+
+
+def execute_cached_query(db_path, query, cache=None, **limits):
+    """
+    execute_safe_query with results cached until the database's data or schema changes.
+
+    Args:
+    db_path (str): The path to the SQLite database file.
+    query (str): The SQL query to execute.
+    cache (QueryResultCache): The cache to use; defaults to the process-wide cache.
+    limits: Passed on to execute_safe_query.
+
+    Returns:
+    dict: The columnar result, as returned by execute_safe_query.
+    """
+    cache = cache or _default_cache
+    key = (os.path.abspath(db_path), normalize_sql(query), tuple(sorted(limits.items())))
+    version = database_version(db_path)
+    with tracing.span("db.cached_query") as span:
+        result = cache.get(key, version)
+        span.set(cache_hit=result is not None)
+        if result is None:
+            result = execute_safe_query(db_path, query, **limits)
+            cache.put(key, version, result)
+        span.set(rows=result["rows"])
+    return result
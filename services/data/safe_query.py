@@ -0,0 +1,243 @@
+import re
+import sqlite3
+import time
+
+from services.data.oper import get_connection
+from services.data.schema import get_schema_catalogue
+from services.monitoring import tracing
+
+# Defaults for queries generated by the LLM
+MAX_ROWS = 200
+TIME_BUDGET = 5.0  # seconds
+INSTRUCTION_BUDGET = 50_000_000  # SQLite VM instructions
+MAX_SCAN_ROWS = 5_000_000
+
+# The progress handler runs every PROGRESS_INTERVAL VM instructions
+PROGRESS_INTERVAL = 10_000
+
+# Defaults for rendering results into prompts
+RESULT_ROWS = 20
+MAX_CELL_CHARS = 40
+
+_FENCE = re.compile(r"^```(?:sql|sqlite)?\s*|\s*```$", re.IGNORECASE)
+_TABLE_REFERENCE = re.compile(
+    r'\b(?:from|join)\s+("[^"]+"|`[^`]+`|\[[^\]]+\]|\w+)(?:\s+(?:as\s+)?(?!on\b|where\b|join\b|group\b|order\b|'
+    r'limit\b|left\b|inner\b|cross\b|natural\b|using\b|union\b|having\b)(\w+))?', re.IGNORECASE)
+_SCAN = re.compile(r"^SCAN (.+?)(?: USING .*)?$")
+
+# Authorizer actions a generated query may perform; anything else (ATTACH, PRAGMA, writes, DDL) is denied
+_ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
+
+class QueryRejectedError(Exception):
+    """
+    Raised when a query is refused before running or stopped because it exceeded its budget.
+    """
+
+
+def clean_query(query):
+    """
+    Strips markdown code fences, surrounding whitespace and trailing semicolons from an LLM-generated query.
+    """
+    return _FENCE.sub("", query.strip()).strip().rstrip(";").strip()
+
+
+def _unquote(name):
+    if name[0] in "\"`[":
+        return name[1:-1]
+    return name
+
+
+def _table_aliases(query):
+    aliases = {}
+    for table, alias in _TABLE_REFERENCE.findall(query):
+        table = _unquote(table)
+        aliases[table] = table
+        if alias:
+            aliases[alias] = table
+    return aliases
+
+
+def estimate_scan_rows(conn, query, row_counts):
+    """
+    Estimates how many rows a query reads from full table scans using EXPLAIN QUERY PLAN.
+
+    Scans that share a parent in the plan are nested loops, so their row counts multiply; the largest such product
+    is returned.
+    """
+    aliases = _table_aliases(query)
+    largest = max(row_counts.values(), default=0)
+    products = {}
+    for _, parent, _, detail in conn.execute(f"EXPLAIN QUERY PLAN {query}"):
+        match = _SCAN.match(detail)
+        if not match or match.group(1) == "CONSTANT ROW" or match.group(1).startswith("("):
+            continue
+        # Aliases the regex could not resolve are assumed to be the largest table
+        rows = row_counts.get(aliases.get(match.group(1), match.group(1)), largest)
+        products[parent] = products.get(parent, 1) * max(rows, 1)
+    return max(products.values(), default=0)
+
+
+def _run_within_budget(conn, query, max_rows, time_budget, instruction_budget):
+    deadline = time.monotonic() + time_budget
+    calls_allowed = max(instruction_budget // PROGRESS_INTERVAL, 1)
+    calls = 0
+    exhausted = []
+
+    def progress():
+        nonlocal calls
+        calls += 1
+        if calls > calls_allowed or time.monotonic() > deadline:
+            exhausted.append(True)
+            return 1
+        return 0
+
+    with tracing.span("db.safe_query", max_rows=max_rows) as span:
+        conn.set_progress_handler(progress, PROGRESS_INTERVAL)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query)
+            columns = [column[0] for column in cursor.description or []]
+            rows = cursor.fetchmany(max_rows)
+            total_rows = len(rows)
+            try:
+                # Count the rest without keeping it; the budget still applies
+                for _ in cursor:
+                    total_rows += 1
+            except sqlite3.OperationalError:
+                if not exhausted:
+                    raise
+                total_rows = None
+        except sqlite3.Error as e:
+            if exhausted:
+                raise QueryRejectedError(
+                    f"Query exceeded its budget of {time_budget}s / {instruction_budget} instructions")
+            raise Exception(f"An error occurred while executing the SQL query: {e}")
+        finally:
+            cursor.close()
+            conn.set_progress_handler(None, 0)
+        span.set(rows=len(rows), total_rows=total_rows)
+    return columns, rows, total_rows
+
+
+def execute_safe_query(db_path, query, max_rows=MAX_ROWS, time_budget=TIME_BUDGET,
+                       instruction_budget=INSTRUCTION_BUDGET, max_scan_rows=MAX_SCAN_ROWS):
+    """
+    Executes an LLM-generated query on a read-only connection within a time, instruction and scan budget.
+
+    Args:
+    db_path (str): The path to the SQLite database file.
+    query (str): The SQL query to execute.
+    max_rows (int): The maximum number of rows to return; further rows are only counted.
+    time_budget (float): Wall-clock seconds the query may run for.
+    instruction_budget (int): SQLite VM instructions the query may run for.
+    max_scan_rows (int): The largest number of rows full table scans may read, per EXPLAIN QUERY PLAN.
+
+    Returns:
+    dict: The result in columnar form: "columns", "data" (a list of values per column), "rows" returned,
+    "total_rows" (None if counting ran out of budget) and "truncated".
+
+    Raises:
+    QueryRejectedError: If the query does anything but read, would scan too many rows or exceeds its budget.
+    Exception: If the query fails to execute.
+    """
+    query = clean_query(query)
+    conn = get_connection(db_path, read_only=True)
+
+    try:
+        row_counts = {table["name"]: table["rows"] for table in get_schema_catalogue(db_path)["tables"]}
+    except sqlite3.Error as e:
+        raise Exception(f"An error occurred while executing the SQL query: {e}")
+
+    denied = []
+
+    def authorize(action, *args):
+        if action in _ALLOWED_ACTIONS:
+            return sqlite3.SQLITE_OK
+        denied.append(action)
+        return sqlite3.SQLITE_DENY
+
+    # mode=ro only protects the main database: without these a query could ATTACH another file and write to it
+    conn.execute("PRAGMA query_only=ON")
+    conn.set_authorizer(authorize)
+    try:
+        try:
+            scan_rows = estimate_scan_rows(conn, query, row_counts)
+        except sqlite3.Error as e:
+            if denied:
+                raise QueryRejectedError("Only SELECT queries are allowed")
+            raise Exception(f"An error occurred while executing the SQL query: {e}")
+        if scan_rows > max_scan_rows:
+            raise QueryRejectedError(
+                f"Query would scan about {scan_rows} rows, more than the limit of {max_scan_rows}")
+        columns, rows, total_rows = _run_within_budget(conn, query, max_rows, time_budget, instruction_budget)
+    finally:
+        conn.set_authorizer(None)
+
+    return {
+        "columns": columns,
+        "data": [list(values) for values in zip(*rows)] if rows else [[] for _ in columns],
+        "rows": len(rows),
+        "total_rows": total_rows,
+        "truncated": total_rows is None or total_rows > len(rows)
+    }
+
+
+def render_query_result(result):
+    """
+    Renders a columnar query result as compact text for a prompt, one line per column.
+    """
+    if not result["columns"]:
+        return "The query returned no columns."
+    lines = [f"{column}: {', '.join(str(value) for value in values)}"
+             for column, values in zip(result["columns"], result["data"])]
+    if result["truncated"]:
+        total = result["total_rows"] if result["total_rows"] is not None else "more than " + str(result["rows"])
+        lines.append(f"(showing {result['rows']} of {total} rows)")
+    else:
+        lines.append(f"({result['rows']} rows)")
+    return "\n".join(lines)
+
+
+def _cell(value, max_chars):
+    text = "NULL" if value is None else str(value).replace("\n", " ").replace("|", "/")
+    return text if len(text) <= max_chars else text[:max_chars - 1] + "…"
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else f"{value:.2f}"
+
+
+def _column_stats(values):
+    numbers = [value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)]
+    if not numbers:
+        return None
+    total = sum(numbers)
+    return (f"min={_number(min(numbers))} max={_number(max(numbers))} mean={_number(total / len(numbers))} "
+            f"sum={_number(total)}")
+
+
+def render_result_table(result, max_rows=RESULT_ROWS, max_cell_chars=MAX_CELL_CHARS):
+    """
+    Renders a columnar query result as a compact table for a prompt: a header and at most max_rows rows with long
+    cells cut off. When rows are left out, summary statistics of the numeric columns over every fetched row follow.
+    """
+    if not result["columns"]:
+        return "The query returned no columns."
+    lines = [" | ".join(_cell(column, max_cell_chars) for column in result["columns"])]
+    shown = min(result["rows"], max_rows)
+    for position in range(shown):
+        lines.append(" | ".join(_cell(values[position], max_cell_chars) for values in result["data"]))
+
+    total = result["total_rows"] if result["total_rows"] is not None else "more than " + str(result["rows"])
+    if shown == result["rows"] and not result["truncated"]:
+        lines.append(f"({result['rows']} rows)")
+        return "\n".join(lines)
+
+    lines.append(f"(showing {shown} of {total} rows)")
+    stats = [(column, _column_stats(values)) for column, values in zip(result["columns"], result["data"])]
+    stats = [f"{column}: {summary}" for column, summary in stats if summary]
+    if stats:
+        scope = "the first" if result["truncated"] else "all"
+        lines.append(f"Statistics over {scope} {result['rows']} rows: " + "; ".join(stats))
+    return "\n".join(lines)
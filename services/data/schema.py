@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import threading
+
+from services.data.oper import get_connection, database_version
+from services.monitoring import tracing
+
+# Default number of prompt tokens the schema summary may use
+SCHEMA_TOKEN_BUDGET = 1500
+
+# In-memory catalogues keyed by absolute database path
+_catalogues = {}
+_catalogues_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    """
+    Rough token count for prompt budgeting (about four characters per token for English text).
+    """
+    return (len(text) + 3) // 4
+
+
+def catalogue_path(db_path):
+    return db_path + ".schema.json"
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def build_schema_catalogue(db_path, sample_size=3):
+    """
+    Computes the schema catalogue of an SQLite database: for every table its row count and, per column, the
+    declared type, distinct count, min, max and the most frequent sample values.
+
+    Args:
+    db_path (str): The path to the SQLite database file.
+    sample_size (int): The number of sample values to keep per column.
+
+    Returns:
+    dict: The catalogue, including the database version it was computed at.
+    """
+    conn = get_connection(db_path, read_only=True)
+    tables = []
+    for table_name, in conn.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name"):
+        columns = conn.execute(f"PRAGMA table_info({_quote(table_name)})").fetchall()
+        selects = ["COUNT(*)"]
+        for column in columns:
+            name = _quote(column[1])
+            selects.extend([f"COUNT(DISTINCT {name})", f"MIN({name})", f"MAX({name})"])
+        stats = conn.execute(f"SELECT {', '.join(selects)} FROM {_quote(table_name)}").fetchone()
+
+        column_entries = []
+        for position, column in enumerate(columns):
+            name = _quote(column[1])
+            distinct, minimum, maximum = stats[1 + position * 3:4 + position * 3]
+            # Samples say nothing about unique columns such as ids
+            samples = [] if distinct == stats[0] else conn.execute(
+                f"SELECT {name} FROM {_quote(table_name)} WHERE {name} IS NOT NULL "
+                f"GROUP BY {name} ORDER BY COUNT(*) DESC LIMIT ?", (sample_size,)).fetchall()
+            column_entries.append({
+                "name": column[1],
+                "type": column[2],
+                "distinct": distinct,
+                "min": minimum,
+                "max": maximum,
+                "samples": [sample for sample, in samples]
+            })
+        tables.append({"name": table_name, "rows": stats[0], "columns": column_entries})
+
+    return {"version": list(database_version(db_path)), "tables": tables}
+
+
+def save_schema_catalogue(catalogue, db_path):
+    with open(catalogue_path(db_path), "w") as f:
+        json.dump(catalogue, f, default=str)
+
+
+def refresh_schema_catalogue(db_path="data_store"):
+    """
+    Rebuilds the catalogue and stores it in memory and on disk. Run by the pipeline after loading data.
+    """
+    catalogue = build_schema_catalogue(db_path)
+    save_schema_catalogue(catalogue, db_path)
+    with _catalogues_lock:
+        _catalogues[os.path.abspath(db_path)] = catalogue
+    return catalogue
+
+
+def get_schema_catalogue(db_path="data_store"):
+    """
+    Returns the schema catalogue, from memory or disk when it matches the current database version and rebuilt
+    otherwise.
+    """
+    with tracing.span("schema.catalogue") as span:
+        version = list(database_version(db_path))
+        key = os.path.abspath(db_path)
+        catalogue = _catalogues.get(key)
+        if catalogue is not None and catalogue["version"] == version:
+            span.set(cache_hit=True)
+            return catalogue
+
+        if os.path.exists(catalogue_path(db_path)):
+            with open(catalogue_path(db_path)) as f:
+                catalogue = json.load(f)
+            if catalogue.get("version") == version:
+                with _catalogues_lock:
+                    _catalogues[key] = catalogue
+                span.set(cache_hit=True)
+                return catalogue
+
+        span.set(cache_hit=False)
+        return refresh_schema_catalogue(db_path)
+
+
+def schema_fingerprint(catalogue):
+    """
+    Hash of the table and column names and types only, so it stays the same when data is reloaded into an
+    unchanged schema.
+    """
+    shape = [[table["name"], [[column["name"], column["type"]] for column in table["columns"]]]
+             for table in catalogue["tables"]]
+    return hashlib.sha1(json.dumps(shape).encode()).hexdigest()
+
+
+def _render_column(column, detail):
+    text = f"{column['name']}:{column['type']}"
+    if detail >= 1:
+        text += f" [{column['distinct']} distinct, min {column['min']!r}, max {column['max']!r}"
+        if detail >= 2 and column["samples"]:
+            text += ", e.g. " + ", ".join(repr(sample) for sample in column["samples"])
+        text += "]"
+    return text
+
+
+def render_schema(catalogue, max_tokens=SCHEMA_TOKEN_BUDGET):
+    """
+    Renders the catalogue for a prompt, dropping sample values, then column statistics, then whole tables until
+    the text fits in max_tokens.
+    """
+    def render(detail, tables):
+        lines = []
+        for table in tables:
+            columns = ", ".join(_render_column(column, detail) for column in table["columns"])
+            lines.append(f"{table['name']} ({table['rows']} rows) has columns ({columns})")
+        return "\n".join(lines)
+
+    tables = catalogue["tables"]
+    for detail in (2, 1, 0):
+        text = render(detail, tables)
+        if estimate_tokens(text) <= max_tokens:
+            return text
+
+    # Even the bare schema is too large: keep as many tables as fit
+    lines = render(0, tables).split("\n")
+    while lines and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines.pop()
+    return "\n".join(lines)
+
+
+def get_schema_summary(db_path="data_store", max_tokens=SCHEMA_TOKEN_BUDGET):
+    """
+    Cached replacement for summarize_schema that includes column statistics within a token budget.
+    """
+    return render_schema(get_schema_catalogue(db_path), max_tokens)
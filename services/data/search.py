@@ -0,0 +1,227 @@
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from services.data.oper import get_connection, database_version
+from services.data.store import IdFilter
+from services.monitoring import tracing
+
+# Constant of reciprocal rank fusion; larger values flatten the difference between top and lower ranks
+RRF_K = 60
+
+# Default number of table and column entities guaranteed a place before field values
+SCHEMA_QUOTAS = {"sqlite table": 3, "sqlite column": 7}
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="search")
+
+
+def build_entity_search_index(database_path="entities.db"):
+    """
+    (Re)builds the FTS5 full-text index over the names and descriptions of the entities table, plus b-tree
+    indexes on the columns entities are looked up by. Run by the pipeline whenever the entities change.
+    """
+    with sqlite3.connect(database_path) as conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS entities_id ON Entities (id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS entities_table_name ON Entities (table_name)")
+        conn.execute("DROP TABLE IF EXISTS entities_fts")
+        conn.execute("CREATE VIRTUAL TABLE entities_fts USING fts5(entity_name, entity_description, "
+                     "content='Entities', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+        conn.execute("INSERT INTO entities_fts (entities_fts) VALUES ('rebuild')")
+
+
+def lexical_query(text):
+    """
+    Turns free text into an FTS5 query that matches any of its words, each quoted so punctuation and keywords in
+    the question can't break the query syntax.
+    """
+    words = dict.fromkeys(word.lower() for word in _WORD.findall(text))
+    return " OR ".join(f'"{word}"' for word in words)
+
+
+def _where(entity_types, tables):
+    clauses = []
+    params = []
+    if entity_types:
+        clauses.append(f"Entities.entity_type IN ({', '.join('?' * len(entity_types))})")
+        params.extend(entity_types)
+    if tables:
+        clauses.append(f"Entities.table_name IN ({', '.join('?' * len(tables))})")
+        params.extend(tables)
+    return clauses, params
+
+
+# Filters kept at most, for as many (database, entity types, tables) combinations
+MAX_FILTERS = 32
+
+# (database path, entity types, tables) -> (database version, IdFilter); only the latest version is kept
+_filters = {}
+_filters_lock = threading.Lock()
+
+
+def _load_filter(database_path, entity_types, tables):
+    clauses, params = _where(entity_types, tables)
+    condition = " AND ".join(clauses)
+    conn = get_connection(database_path, read_only=True)
+    matching, total = conn.execute(f"SELECT COUNT(*) FILTER (WHERE {condition}), COUNT(*) FROM Entities",
+                                   params).fetchone()
+    if matching * 2 <= total:
+        return IdFilter(row[0] for row in conn.execute(f"SELECT id FROM Entities WHERE {condition}", params))
+    # Most entities match (e.g. all field values), so the filter holds the few that don't
+    return IdFilter((row[0] for row in conn.execute(f"SELECT id FROM Entities WHERE NOT IFNULL({condition}, 0)",
+                                                   params)), exclude=True)
+
+
+def entity_filter(database_path="entities.db", entity_types=None, tables=None):
+    """
+    Returns an IdFilter for the entities of the given types and/or tables, or None when neither is given. A filter
+    holds the matching ids or, when that is the smaller set, the ids to exclude. Filters are cached until the
+    entities database changes.
+    """
+    if not entity_types and not tables:
+        return None
+    key = (os.path.abspath(database_path), tuple(sorted(entity_types or ())), tuple(sorted(tables or ())))
+    version = database_version(database_path)
+    cached = _filters.get(key)
+    if cached is None or cached[0] != version:
+        cached = (version, _load_filter(database_path, key[1], key[2]))
+        with _filters_lock:
+            _filters.pop(key, None)
+            while len(_filters) >= MAX_FILTERS:
+                _filters.pop(next(iter(_filters)))
+            _filters[key] = cached
+    return cached[1]
+
+
+def lexical_search(database_path, text, k=20, entity_types=None, tables=None):
+    """
+    BM25 search over entity names and descriptions. Matches in the name weigh twice as much as in the description.
+
+    Returns:
+    list: Entity ids, best match first.
+    """
+    query = lexical_query(text)
+    if not query:
+        return []
+    clauses, params = _where(entity_types, tables)
+    conditions = "".join(f" AND {clause}" for clause in clauses)
+    conn = get_connection(database_path, read_only=True)
+    with tracing.span("search.lexical", k=k) as span:
+        try:
+            rows = conn.execute("SELECT entities_fts.rowid FROM entities_fts "
+                                "JOIN Entities ON Entities.id = entities_fts.rowid "
+                                f"WHERE entities_fts MATCH ?{conditions} "
+                                "ORDER BY bm25(entities_fts, 2.0, 1.0) LIMIT ?", [query, *params, k]).fetchall()
+        except sqlite3.Error as e:
+            print(f"An error occurred during lexical search: {e}")
+            return []
+        span.set(rows=len(rows))
+    return [row[0] for row in rows]
+
+
+def vector_search_batch(service, embeddings, k=20, filter=None):
+    """
+    HNSW search for the k nearest entities of each embedding, in one index call. hnswlib already scores its
+    candidates exactly against the float32 vectors it holds, so there is nothing to gain from re-ranking them.
+
+    Returns:
+    list: One list of entity ids per embedding, nearest first.
+    """
+    labels, distances = service.query(np.asarray(embeddings, dtype=np.float32), k=k, filter=filter)
+    return [[int(label) for label in row] for row in labels]
+
+
+def vector_search(service, embedding, k=20, filter=None):
+    return vector_search_batch(service, [embedding], k, filter)[0]
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """
+    Fuses several rankings of ids: each id scores the sum of 1 / (k + rank) over the rankings it appears in.
+
+    Returns:
+    list: Ids ordered by fused score.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, start=1):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda item_id: -scores[item_id])
+
+
+def hybrid_search(service, embedding, text, database_path="entities.db", k=20, candidates=50, entity_types=None,
+                  tables=None):
+    """
+    Runs the vector and the lexical search in parallel and fuses their rankings with reciprocal rank fusion.
+
+    Args:
+    service (IndexingService): The vector index.
+    embedding (np.ndarray): The embedding of the question.
+    text (str): The question text for the lexical search.
+    database_path (str): The entities database with its FTS5 index.
+    k (int): The number of ids to return.
+    candidates (int): How many results to take from each search before fusing.
+    entity_types (list): Only return entities of these types.
+    tables (list): Only return entities of these tables.
+
+    Returns:
+    list: Entity ids, best first.
+    """
+    filter = entity_filter(database_path, entity_types, tables)
+    vector = _executor.submit(vector_search, service, embedding, candidates, filter)
+    lexical = _executor.submit(lexical_search, database_path, text, candidates, entity_types, tables)
+    return reciprocal_rank_fusion([vector.result(), lexical.result()])[:k]
+
+
+def quota_search_batch(service, embeddings, texts, database_path="entities.db", k=20, quotas=None, tables=None,
+                       candidates=50):
+    """
+    quota_search for several questions at once: each vector search is a single batched index call.
+
+    Returns:
+    list: One list of entity ids per question, tables and columns first.
+    """
+    with tracing.span("search.quota", queries=len(texts), k=k):
+        return _quota_search_batch(service, embeddings, texts, database_path, k, quotas, tables, candidates)
+
+
+def _quota_search_batch(service, embeddings, texts, database_path, k, quotas, tables, candidates):
+    quotas = SCHEMA_QUOTAS if quotas is None else quotas
+    searches = [_executor.submit(vector_search_batch, service, embeddings, quota,
+                                 entity_filter(database_path, [entity_type], tables))
+                for entity_type, quota in quotas.items() if quota > 0]
+    fields = _executor.submit(vector_search_batch, service, embeddings, candidates,
+                              entity_filter(database_path, ["sqlite field"], tables))
+    lexical = [_executor.submit(lexical_search, database_path, text, candidates, ["sqlite field"], tables)
+               for text in texts]
+
+    schema_ids = [search.result() for search in searches]
+    field_ids = fields.result()
+    results = []
+    for position in range(len(texts)):
+        entity_ids = [entity_id for ranking in schema_ids for entity_id in ranking[position]][:k]
+        remaining = k - len(entity_ids)
+        if remaining > 0:
+            entity_ids.extend(reciprocal_rank_fusion([field_ids[position], lexical[position].result()])[:remaining])
+        results.append(entity_ids)
+    return results
+
+
+def quota_search(service, embedding, text, database_path="entities.db", k=20, quotas=None, tables=None):
+    """
+    Retrieves the best tables and columns first, up to their quotas, and fills the remaining places with field
+    values from the hybrid search, so field values can't crowd the schema out of the prompt.
+
+    Args:
+    quotas (dict): The number of places reserved per entity type; defaults to SCHEMA_QUOTAS.
+    tables (list): Only return entities of these tables.
+
+    Returns:
+    list: Entity ids, tables and columns first.
+    """
+    return quota_search_batch(service, [embedding], [text], database_path, k, quotas, tables)[0]
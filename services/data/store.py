@@ -1,7 +1,26 @@
+import json
+import os
+import re
+import shutil
 import sqlite3
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from sqlite3 import Error
 import hnswlib
 import numpy as np
+import pandas as pd
+
+from services.monitoring import tracing
+
+# Rows read from a CSV file at a time during ingestion
+CSV_CHUNKSIZE = 100000
+
+# Column name tokens that generated queries typically filter on, and which get an index on ingestion
+INDEXED_COLUMN_TOKENS = {"id", "date", "day", "time", "timestamp", "datetime", "month", "year"}
+
+# Filtered queries matching at most this many live items are answered by brute force: with so few matches hnswlib
+# would visit most of the graph, calling the Python filter for every node it passes
+EXACT_FILTER_MAX = 2048
 
 
 def dataframe_to_sqlite(table_name, dataframe, db_file="data_store"):
@@ -34,25 +53,468 @@ def dataframe_to_sqlite(table_name, dataframe, db_file="data_store"):
             conn.close()
 
 
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def should_index(column_name):
+    """
+    Whether a column looks like an id or date column, e.g. "Date", "order_id", "CustomerID" or "Delivery date".
+    """
+    if re.search(r"[a-z](Id|ID)$", column_name):
+        return True
+    tokens = re.split(r"[^0-9a-z]+", column_name.lower())
+    return bool(INDEXED_COLUMN_TOKENS.intersection(tokens))
+
+
+def _create_column_indexes(conn, table_name, columns):
+    for column in columns:
+        if should_index(column):
+            index_name = re.sub(r"\W+", "_", f"{table_name}_{column}").lower()
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {_quote(index_name)} ON {_quote(table_name)} ({_quote(column)})")
+
+
+def _swap_in(conn, staging, table_name):
+    # Runs inside the ingestion transaction, so readers see either the old or the new table
+    conn.execute(f"DROP TABLE IF EXISTS {_quote(table_name)}")
+    conn.execute(f"ALTER TABLE {_quote(staging)} RENAME TO {_quote(table_name)}")
+    columns = [column[1] for column in conn.execute(f"PRAGMA table_info({_quote(table_name)})")]
+    _create_column_indexes(conn, table_name, columns)
+
+
+def _begin(db_file):
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("BEGIN IMMEDIATE")
+    return conn
+
+
+def infer_csv_dtypes(file_path, chunksize=CSV_CHUNKSIZE, sep=";"):
+    """
+    Infers one type per column over the whole file, so every chunk of a chunked load is parsed the same way: columns
+    that are integer or float throughout stay numeric, anything else is read as text (keeping e.g. the leading zeros
+    of codes that only some chunks would have parsed as numbers).
+
+    Returns:
+    dict: Column name to dtype, for pandas.read_csv.
+    """
+    kinds = {}
+    for chunk in pd.read_csv(file_path, sep=sep, chunksize=chunksize):
+        for column, column_dtype in chunk.dtypes.items():
+            kinds.setdefault(column, set()).add(column_dtype.kind)
+    dtypes = {}
+    for column, column_kinds in kinds.items():
+        if column_kinds == {"i"}:
+            dtypes[column] = "int64"
+        elif column_kinds <= {"i", "f"}:
+            dtypes[column] = "float64"
+        elif column_kinds == {"b"}:
+            dtypes[column] = "bool"
+        else:
+            dtypes[column] = str
+    return dtypes
+
+
+def csv_to_sqlite(file_path, table_name, db_file="data_store", chunksize=CSV_CHUNKSIZE, dtype=None, sep=";"):
+    """
+    Streams a CSV file into an SQLite table chunk by chunk, so files larger than memory can be loaded.
+
+    The rows are written to a staging table that replaces the existing table at the end of the same transaction, so
+    a failure leaves the previous table intact. Id and date columns are indexed.
+
+    Parameters:
+    file_path (str): The path to the CSV file.
+    table_name (str): The name of the table to create or replace.
+    db_file (str): The path to the SQLite database file.
+    chunksize (int): The number of rows to read and insert at a time.
+    dtype (dict): Explicit types for some or all columns; the rest are inferred over the whole file first with
+        infer_csv_dtypes, so all chunks agree.
+    sep (str): The CSV delimiter.
+
+    Returns:
+    int: The number of rows loaded.
+    """
+    staging = f"{table_name}__staging"
+    dtype = {**infer_csv_dtypes(file_path, chunksize, sep), **(dtype or {})}
+    conn = _begin(db_file)
+    rows = 0
+    try:
+        conn.execute(f"DROP TABLE IF EXISTS {_quote(staging)}")
+        insert = None
+        for chunk in pd.read_csv(file_path, sep=sep, chunksize=chunksize, dtype=dtype):
+            if insert is None:
+                conn.execute(pd.io.sql.get_schema(chunk, staging, con=conn))
+                insert = (f"INSERT INTO {_quote(staging)} VALUES ({', '.join('?' * len(chunk.columns))})")
+            values = chunk.astype(object).where(chunk.notna(), None)
+            conn.executemany(insert, values.itertuples(index=False, name=None))
+            rows += len(chunk)
+        _swap_in(conn, staging, table_name)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    print(f"Loaded {rows} rows from {file_path} into table '{table_name}'.")
+    return rows
+
+
+def copy_table(source_db, table_name, db_file="data_store"):
+    """
+    Copies a table from another SQLite database, replacing the table of the same name in db_file atomically.
+    """
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS source", (source_db,))
+        create, = conn.execute("SELECT sql FROM source.sqlite_master WHERE type='table' AND name=?",
+                               (table_name,)).fetchone()
+        staging = f"{table_name}__staging"
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f"DROP TABLE IF EXISTS main.{_quote(staging)}")
+            conn.execute(create.replace(_quote(table_name), f"main.{_quote(staging)}", 1))
+            conn.execute(f"INSERT INTO main.{_quote(staging)} SELECT * FROM source.{_quote(table_name)}")
+            _swap_in(conn, staging, table_name)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("DETACH DATABASE source")
+    finally:
+        conn.close()
+
+
+def _ingest_to_scratch(file_path, table_name, scratch_dir, chunksize, dtype, sep):
+    scratch_db = os.path.join(scratch_dir, f"{table_name}.db")
+    csv_to_sqlite(file_path, table_name, scratch_db, chunksize, dtype, sep)
+    return scratch_db
+
+
+def csvs_to_sqlite(files, db_file="data_store", workers=None, chunksize=CSV_CHUNKSIZE, sep=";", dtype=None):
+    """
+    Loads several CSV files, given as (file_path, table_name) pairs. With workers > 1 the files are parsed in
+    parallel processes, each into its own scratch database, and then copied into db_file one table at a time, as
+    SQLite allows only one writer.
+
+    dtype maps column names to explicit types; it applies to every file that has the column.
+    """
+    if not workers or workers <= 1 or len(files) <= 1:
+        for file_path, table_name in files:
+            csv_to_sqlite(file_path, table_name, db_file, chunksize, dtype, sep)
+        return
+
+    scratch_dir = tempfile.mkdtemp(prefix="ingest-", dir=os.path.dirname(os.path.abspath(db_file)))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [(table_name, executor.submit(_ingest_to_scratch, file_path, table_name, scratch_dir,
+                                                    chunksize, dtype, sep))
+                       for file_path, table_name in files]
+            for table_name, future in futures:
+                copy_table(future.result(), table_name, db_file)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+class IndexManifestError(ValueError):
+    """
+    Raised when a saved index does not match the settings of the IndexingService loading it.
+    """
+
+
+class IdFilter:
+    """
+    Restricts a query to a set of ids, or with exclude=True to every id but those. Instances are passed to hnswlib
+    as its filter callback.
+    """
+
+    def __init__(self, ids, exclude=False):
+        self.ids = frozenset(int(item_id) for item_id in ids)
+        self.exclude = exclude
+
+    def __call__(self, label):
+        return (label in self.ids) != self.exclude
+
+
+def exact_knn(data, queries, k, space='cosine'):
+    """
+    Brute-force k nearest neighbours of queries among the rows of data, as positions into data.
+    """
+    if space == 'l2':
+        scores = -((queries ** 2).sum(1)[:, None] - 2 * queries @ data.T + (data ** 2).sum(1)[None, :])
+    else:
+        if space == 'cosine':
+            data = data / np.maximum(np.linalg.norm(data, axis=1, keepdims=True), 1e-12)
+            queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        scores = queries @ data.T
+    k = min(k, data.shape[0])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(scores, np.take_along_axis(top, order, axis=1),
+                                                                      axis=1)
+
+
+def manifest_path(index_path):
+    return index_path + ".manifest.json"
+
+
 class IndexingService:
-    def __init__(self, space='cosine', dim=768, max_elements=1000):
+    def __init__(self, space='cosine', dim=768, max_elements=1000, model_name=None, ef_construction=200, M=16,
+                 ef=100, target_recall=None):
+        self.space = space
         self.dim = dim
+        self.model_name = model_name
+        self.ef_construction = ef_construction
+        self.M = M
+        self.ef = ef
+        self.target_recall = target_recall
+        # Items added or deleted since ef was last tuned
+        self.changes_since_tune = 0
+        self.deleted = set()
+        # Every label in the index, deleted ones included
+        self.ids = set()
         self.index = hnswlib.Index(space=space, dim=dim)
-        self.index.init_index(max_elements=max_elements, ef_construction=200, M=16)
-        self.index.set_ef(1800)  # Set higher for more accurate but slower search
+        self.index.init_index(max_elements=max_elements, ef_construction=ef_construction, M=M)
+        self.index.set_ef(ef)  # Set higher for more accurate but slower search; tune_ef picks it from a target recall
+
+    @property
+    def count(self):
+        """
+        The number of live (not deleted) items in the index.
+        """
+        return self.index.get_current_count() - len(self.deleted)
+
+    def _ensure_capacity(self, extra):
+        needed = self.index.get_current_count() + extra
+        capacity = self.index.get_max_elements()
+        if needed > capacity:
+            # Grow geometrically so repeated small additions don't resize every time
+            self.index.resize_index(max(needed, capacity * 2))
 
     def add_items(self, embeddings, ids):
+        """
+        Adds items to the index, growing it as needed. Existing ids are replaced (upsert), and ids that were
+        previously deleted are restored with the new embedding.
+        """
+        ids = [int(item_id) for item_id in ids]
+        self._ensure_capacity(len(ids))
         self.index.add_items(embeddings, ids)
+        self.ids.update(ids)
+        self.deleted.difference_update(ids)
+        self.changes_since_tune += len(ids)
+
+    def upsert_items(self, embeddings, ids):
+        self.add_items(embeddings, ids)
+
+    def delete_items(self, ids):
+        """
+        Marks the given ids as deleted so they no longer appear in query results. Unknown ids are ignored.
+
+        Returns:
+        int: The number of items that were deleted.
+        """
+        removed = 0
+        for item_id in ids:
+            item_id = int(item_id)
+            if item_id in self.deleted:
+                continue
+            try:
+                self.index.mark_deleted(item_id)
+            except RuntimeError:
+                continue
+            self.deleted.add(item_id)
+            removed += 1
+        self.changes_since_tune += removed
+        return removed
+
+    def manifest(self):
+        return {
+            "dim": self.dim,
+            "space": self.space,
+            "model_name": self.model_name,
+            "count": self.count,
+            "max_elements": self.index.get_max_elements(),
+            "M": self.M,
+            "ef_construction": self.ef_construction,
+            "ef": self.ef,
+            "target_recall": self.target_recall,
+            "changes_since_tune": self.changes_since_tune,
+            "deleted": sorted(self.deleted)
+        }
 
     def save_index(self, path='hnsw_index.bin'):
-        self.index.save_index(path)
+        """
+        Saves the index and its manifest under temporary names and renames them into place, so readers (e.g.
+        ChatResources.refresh) never load a partly written file.
+        """
+        temp_path = path + f".tmp-{os.getpid()}"
+        self.index.save_index(temp_path)
+        with open(manifest_path(temp_path), "w") as f:
+            json.dump(self.manifest(), f)
+        # The index goes last: readers reload when it changes, and by then its manifest is in place
+        os.replace(manifest_path(temp_path), manifest_path(path))
+        os.replace(temp_path, path)
+
+    def _validate_manifest(self, manifest, path):
+        for key in ("dim", "space"):
+            if manifest.get(key) != getattr(self, key):
+                raise IndexManifestError(
+                    f"Index {path} was built with {key}={manifest.get(key)!r}, expected {getattr(self, key)!r}")
+        if self.model_name and manifest.get("model_name") and manifest["model_name"] != self.model_name:
+            raise IndexManifestError(
+                f"Index {path} was built with model {manifest['model_name']!r}, expected {self.model_name!r}")
+
+    def load_index(self, path='hnsw_index.bin', max_elements=0):
+        """
+        Loads a saved index, validating it against its manifest when one exists.
+
+        Args:
+        path (str): The path to the saved index.
+        max_elements (int): The capacity to load the index with; 0 keeps the saved capacity.
+
+        Raises:
+        IndexManifestError: If the manifest does not match this service's dim, space or model name.
+        """
+        manifest = None
+        if os.path.exists(manifest_path(path)):
+            with open(manifest_path(path)) as f:
+                manifest = json.load(f)
+            self._validate_manifest(manifest, path)
+        else:
+            print(f"No manifest found for index {path}; skipping validation.")
+
+        # Load into a fresh index rather than over the one allocated by __init__
+        self.index = hnswlib.Index(space=self.space, dim=self.dim)
+        with tracing.span("index.load") as span:
+            self.index.load_index(path, max_elements=max_elements)
+            span.set(items=self.index.get_current_count())
+        self.ids = set(self.index.get_ids_list())
+        if manifest:
+            self.model_name = self.model_name or manifest.get("model_name")
+            self.M = manifest.get("M", self.M)
+            self.ef_construction = manifest.get("ef_construction", self.ef_construction)
+            self.ef = manifest.get("ef", self.ef)
+            self.target_recall = manifest.get("target_recall", self.target_recall)
+            self.changes_since_tune = manifest.get("changes_since_tune", 0)
+            self.deleted = set(manifest.get("deleted", []))
+        # ef is not stored in the index file itself
+        self.index.set_ef(self.ef)
+
+    def query(self, queries, k=5, filter=None):
+        """
+        Finds the k nearest items to each query.
 
-    def load_index(self, path='hnsw_index.bin'):
-        self.index.load_index(path)
+        Args:
+        queries (np.ndarray): A (n, dim) array of query embeddings.
+        k (int): The number of neighbours per query.
+        filter (IdFilter): Only return items the filter accepts.
+        """
+        # hnswlib raises if asked for more neighbours than there are live (matching) items. The filter may name ids
+        # the index doesn't hold (yet), e.g. while the entities and the index are refreshed one after the other.
+        k = min(k, self.count)
+        with tracing.span("index.query", queries=len(queries), k=k, filtered=filter is not None) as span:
+            if filter is None:
+                return self.index.knn_query(queries, k=k)
+            listed = (filter.ids & self.ids) - self.deleted
+            k = min(k, self.count - len(listed) if filter.exclude else len(listed))
+            if k == 0 or not filter.exclude and len(listed) <= EXACT_FILTER_MAX:
+                span.set(exact=True)
+                ids = np.array(sorted(listed) if k else [], dtype=np.int64)
+                return self._exact_search(queries, k, ids, distances=True)
+            # The filter is a Python callback, so searching with several threads only adds GIL contention
+            return self.index.knn_query(queries, k=k, num_threads=1, filter=filter)
+
+    def live_ids(self):
+        return np.array(sorted(self.ids - self.deleted), dtype=np.int64)
+
+    def exact_query(self, queries, k=5, chunk_size=100000, store=None):
+        """
+        Exact k nearest live items, computed by brute force in chunks of chunk_size stored vectors.
+
+        Args:
+        store (EmbeddingStore): Read the vectors from this memory-mapped store instead of copying them out of the
+            index. A quantized store gives approximately exact neighbours.
+
+        Returns:
+        np.ndarray: A (n, k) array of labels, nearest first.
+        """
+        return self._exact_search(queries, k, self.live_ids(), chunk_size, store=store)[0]
+
+    def _vector_chunks(self, ids, chunk_size, store=None):
+        if store is None:
+            for start in range(0, len(ids), chunk_size):
+                chunk = ids[start:start + chunk_size]
+                yield chunk, np.asarray(self.index.get_items(chunk), dtype=np.float32)
+            return
+        for chunk, vectors in store.iter_chunks(chunk_size):
+            keep = np.isin(chunk, ids)
+            yield chunk[keep], vectors[keep]
+
+    def _exact_search(self, queries, k, ids, chunk_size=100000, distances=False, store=None):
+        """
+        Brute-force k nearest neighbours among the given live ids. Returns labels and similarity scores, or with
+        distances=True labels and distances in the form knn_query returns them.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        best_ids = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for chunk, vectors in self._vector_chunks(ids, chunk_size, store):
+            if len(chunk) == 0:
+                continue
+            positions, scores = exact_knn(vectors, queries, k, self.space)
+            merged_ids = np.concatenate([best_ids, chunk[positions]], axis=1)
+            merged_scores = np.concatenate([best_scores, scores], axis=1)
+            order = np.argsort(-merged_scores, axis=1)[:, :k]
+            best_ids = np.take_along_axis(merged_ids, order, axis=1)
+            best_scores = np.take_along_axis(merged_scores, order, axis=1)
+        if not distances:
+            return best_ids, best_scores
+        # hnswlib reports squared l2 distances, and 1 - similarity for the cosine and inner product spaces
+        return best_ids.astype(np.uint64), (-best_scores if self.space == 'l2' else 1 - best_scores)
+
+    def recall(self, queries, k=5, exact=None):
+        """
+        Fraction of the exact k nearest neighbours that the HNSW search returns at the current ef.
+        """
+        exact = self.exact_query(queries, k) if exact is None else exact
+        labels, _ = self.query(queries, k=k)
+        return float(np.mean([len(set(found) & set(expected)) / max(len(expected), 1)
+                              for found, expected in zip(labels, exact)]))
+
+    def tune_ef(self, target_recall=0.95, k=20, sample_size=200, candidates=(16, 32, 64, 100, 200, 400, 800, 1600),
+                seed=0, store=None):
+        """
+        Picks the smallest ef whose recall@k reaches target_recall, measured against exact search for a sample of
+        stored items perturbed with a little noise. The choice and target are kept in the manifest on save.
+
+        With an EmbeddingStore holding the same items, the sample and the exact neighbours are read from its
+        memory-mapped vectors rather than copied out of the index.
+
+        Returns:
+        tuple: (chosen ef, recall at that ef)
+        """
+        ids = self.live_ids()
+        if len(ids) == 0:
+            return self.ef, 1.0
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(ids, size=min(sample_size, len(ids)), replace=False)
+        if store is None:
+            queries = np.asarray(self.index.get_items(sample), dtype=np.float32)
+        else:
+            queries = store.get(sample)
+        queries += rng.normal(scale=0.01, size=queries.shape).astype(np.float32)
+        k = min(k, len(ids))
+        exact = self.exact_query(queries, k, store=store)
 
-    def query(self, queries, k=5):
-        labels, distances = self.index.knn_query(queries, k=k)
-        return labels, distances
+        recall = 0.0
+        for ef in candidates:
+            self.index.set_ef(ef)
+            recall = self.recall(queries, k, exact)
+            if recall >= target_recall:
+                break
+        self.ef = ef
+        self.target_recall = target_recall
+        self.changes_since_tune = 0
+        return ef, recall
 
     def get_item(self, chunk_id):
         embedding = self.index.get_items([chunk_id])
@@ -1,16 +1,83 @@
+import threading
+
 from sentence_transformers import SentenceTransformer
 
+from services.monitoring import tracing
+
+DEFAULT_MODEL_NAME = 'xlm-r-bert-base-nli-stsb-mean-tokens'
+DEFAULT_BATCH_SIZE = 64
+
+# Process-wide registry of loaded models, keyed by (model_name, device)
+_services = {}
+_services_lock = threading.Lock()
+
 
 class EmbeddingService:
-    def __init__(self, model_name):
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, model_name, device=None):
+        self.model_name = model_name
+        self.device = device
+        self.model = SentenceTransformer(model_name, device=device)
 
     def encode(self, text, normal):
-        return self.model.encode(text, show_progress_bar=False, normalize_embeddings=normal)
+        with tracing.span("embed.encode", texts=1):
+            return self.model.encode(text, show_progress_bar=False, normalize_embeddings=normal)
+
+    def encode_many(self, texts, normal=True, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Encodes a sequence of texts in batches of batch_size and returns a (len(texts), dim) numpy array.
+        """
+        texts = list(texts)
+        with tracing.span("embed.encode_many", texts=len(texts)):
+            return self.model.encode(texts, batch_size=batch_size, show_progress_bar=False,
+                                     normalize_embeddings=normal, convert_to_numpy=True)
+
+
+def get_embedding_service(model_name=DEFAULT_MODEL_NAME, device=None):
+    """
+    Returns the EmbeddingService for the given model and device, loading the model only once per process.
+
+    Args:
+    model_name (str): The name of the SentenceTransformer model.
+    device (str): The device to load the model on (e.g. "cpu", "cuda"), or None to let the library choose.
+
+    Returns:
+    EmbeddingService: The shared service instance.
+    """
+    key = (model_name, device)
+    service = _services.get(key)
+    if service is None:
+        with _services_lock:
+            # Re-check under the lock so concurrent callers don't load the same model twice
+            service = _services.get(key)
+            if service is None:
+                service = EmbeddingService(model_name, device)
+                _services[key] = service
+    return service
+
+
+def warm_up(model_name=DEFAULT_MODEL_NAME, device=None):
+    """
+    Loads the model and runs a single encode so the first real request doesn't pay the start-up cost.
+    """
+    service = get_embedding_service(model_name, device)
+    service.encode("warm up", True)
+    return service
+
+
+def clear_models():
+    """
+    Drops every loaded model from the registry.
+    """
+    with _services_lock:
+        _services.clear()
 
 
-def generate_embedding(text, normal=True, model_name='xlm-r-bert-base-nli-stsb-mean-tokens'):
-    service = EmbeddingService(model_name)
+def generate_embedding(text, normal=True, model_name=DEFAULT_MODEL_NAME, device=None):
+    service = get_embedding_service(model_name, device)
     return service.encode(text, normal)
 
 
+def generate_embeddings_batch(texts, normal=True, batch_size=DEFAULT_BATCH_SIZE, model_name=DEFAULT_MODEL_NAME,
+                              device=None):
+    service = get_embedding_service(model_name, device)
+    return service.encode_many(texts, normal, batch_size)
@@ -0,0 +1,193 @@
+import json
+import os
+
+import numpy as np
+
+# Supported storage types: full precision, half precision and int8 scalar quantization with a scale per vector
+DTYPES = ("float32", "float16", "int8")
+
+
+def _paths(path):
+    return {
+        "vectors": path + ".npy",
+        "ids": path + ".ids.npy",
+        "scales": path + ".scales.npy",
+        "meta": path + ".json"
+    }
+
+
+def quantize(embeddings, dtype):
+    """
+    Converts float32 embeddings to the storage type. Returns (stored vectors, per-vector scales or None).
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype == "int8":
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8), scales.astype(np.float32)
+    return embeddings.astype(dtype), None
+
+
+class EmbeddingStoreWriter:
+    """
+    Writes entity embeddings to a memory-mapped store, chunk by chunk, without holding them all in memory.
+
+    The files are written under temporary names and renamed over the old ones on close, so readers that still have
+    the previous store memory-mapped keep a valid (if outdated) copy instead of a truncated file. When the with block
+    raises, the temporary files are discarded instead and the previous store stays in place.
+
+    path: base path of the store files (<path>.npy, <path>.ids.npy, <path>.scales.npy and <path>.json).
+    capacity: the maximum number of embeddings that will be appended.
+    """
+
+    def __init__(self, path, capacity, dim, dtype="float16", model_name=None):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported embedding store dtype {dtype!r}, expected one of {DTYPES}")
+        self.path = path
+        self.dim = dim
+        self.dtype = dtype
+        self.model_name = model_name
+        self.count = 0
+        paths = _paths(path + f".tmp-{os.getpid()}")
+        self._temp_paths = paths
+        capacity = max(capacity, 1)
+        self._vectors = np.lib.format.open_memmap(paths["vectors"], mode="w+", dtype=dtype, shape=(capacity, dim))
+        self._ids = np.lib.format.open_memmap(paths["ids"], mode="w+", dtype=np.int64, shape=(capacity,))
+        self._scales = None
+        if dtype == "int8":
+            self._scales = np.lib.format.open_memmap(paths["scales"], mode="w+", dtype=np.float32,
+                                                     shape=(capacity,))
+
+    def append(self, ids, embeddings):
+        vectors, scales = quantize(embeddings, self.dtype)
+        end = self.count + len(vectors)
+        self._vectors[self.count:end] = vectors
+        self._ids[self.count:end] = ids
+        if self._scales is not None:
+            self._scales[self.count:end] = scales
+        self.count = end
+
+    def append_quantized(self, ids, vectors, scales=None):
+        # Copies already-stored vectors without a round trip through float32
+        end = self.count + len(vectors)
+        self._vectors[self.count:end] = vectors
+        self._ids[self.count:end] = ids
+        if self._scales is not None:
+            self._scales[self.count:end] = scales
+        self.count = end
+
+    def close(self):
+        for array in (self._vectors, self._ids, self._scales):
+            if array is not None:
+                array.flush()
+        self._vectors = self._ids = self._scales = None
+        with open(self._temp_paths["meta"], "w") as f:
+            json.dump({"count": self.count, "dim": self.dim, "dtype": self.dtype, "model_name": self.model_name}, f)
+        # The metadata goes last: readers reload when it changes, and by then the arrays are in place
+        for key in ("vectors", "ids", "scales", "meta"):
+            if os.path.exists(self._temp_paths[key]):
+                os.replace(self._temp_paths[key], _paths(self.path)[key])
+
+    def abort(self):
+        """
+        Discards the temporary files, leaving the existing store untouched.
+        """
+        self._vectors = self._ids = self._scales = None
+        for temp_path in self._temp_paths.values():
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # A block that raised (or was interrupted) must not replace the complete store with a partial one
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class EmbeddingStore:
+    """
+    Read-only view of an embedding store. Vectors stay memory-mapped and are only read and dequantized for the
+    rows that are asked for.
+    """
+
+    def __init__(self, path):
+        paths = _paths(path)
+        with open(paths["meta"]) as f:
+            meta = json.load(f)
+        self.path = path
+        self.count = meta["count"]
+        self.dim = meta["dim"]
+        self.dtype = meta["dtype"]
+        self.model_name = meta.get("model_name")
+        self.vectors = np.load(paths["vectors"], mmap_mode="r")[:self.count]
+        self.ids = np.load(paths["ids"], mmap_mode="r")[:self.count]
+        self.scales = np.load(paths["scales"], mmap_mode="r")[:self.count] if self.dtype == "int8" else None
+        self._order = np.argsort(self.ids, kind="stable")
+        self._sorted_ids = self.ids[self._order]
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(_paths(path)["meta"])
+
+    def __len__(self):
+        return self.count
+
+    def positions(self, ids):
+        """
+        Returns the row positions of the given ids, or -1 for ids that aren't stored.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.count == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        found = np.minimum(np.searchsorted(self._sorted_ids, ids), self.count - 1)
+        return np.where(self._sorted_ids[found] == ids, self._order[found], -1)
+
+    def dequantize(self, positions):
+        vectors = np.asarray(self.vectors[positions], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= np.asarray(self.scales[positions])[:, None]
+        return vectors
+
+    def get(self, ids):
+        """
+        Returns the float32 embeddings of the given ids; rows of ids that aren't stored are zero.
+        """
+        positions = self.positions(ids)
+        vectors = np.zeros((len(positions), self.dim), dtype=np.float32)
+        present = positions >= 0
+        if present.any():
+            vectors[present] = self.dequantize(positions[present])
+        return vectors
+
+    def iter_chunks(self, chunk_size=100000):
+        """
+        Yields (ids, float32 embeddings) in storage order.
+        """
+        for start in range(0, self.count, chunk_size):
+            positions = np.arange(start, min(start + chunk_size, self.count))
+            yield np.asarray(self.ids[positions]), self.dequantize(positions)
+
+
+def rewrite_embedding_store(path, delete_ids, ids, embeddings, dtype=None, chunk_size=100000):
+    """
+    Rewrites a store without delete_ids and with the given new embeddings appended, replacing the old files only
+    once the new ones are complete.
+    """
+    old = EmbeddingStore(path)
+    delete_ids = np.asarray(list(delete_ids) + list(ids), dtype=np.int64)
+    writer = EmbeddingStoreWriter(path, old.count + len(ids), old.dim, dtype or old.dtype, old.model_name)
+    with writer:
+        for start in range(0, old.count, chunk_size):
+            positions = np.arange(start, min(start + chunk_size, old.count))
+            keep = positions[~np.isin(old.ids[positions], delete_ids)]
+            if writer.dtype == old.dtype:
+                scales = old.scales[keep] if old.scales is not None else None
+                writer.append_quantized(old.ids[keep], old.vectors[keep], scales)
+            else:
+                writer.append(old.ids[keep], old.dequantize(keep))
+        if len(ids):
+            writer.append(ids, embeddings)
@@ -0,0 +1,237 @@
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Upper bounds (seconds) of the latency histogram buckets exported to Prometheus
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Span attributes summed into counters; others (k, attempt, ...) are only kept on the spans themselves
+COUNTED_ATTRIBUTES = {"rows", "total_rows", "ids", "texts", "items", "queries", "tables", "cache_hit",
+                      "input_tokens", "output_tokens", "prompt_chars", "prompt_tokens", "tokens_saved"}
+# Finished spans kept in memory for summaries and JSON lines dumps
+MAX_SPANS = 10000
+
+# The turn a span belongs to; stage graphs copy it into the threads they run stages in
+_current_turn = contextvars.ContextVar("trace_turn", default=None)
+
+# None while tracing is off, so span() only costs a global lookup and returns a shared no-op span
+_tracer = None
+
+
+class Span:
+    """
+    A timed operation. Attributes such as token counts, rows and cache hits can be added with set() while it runs;
+    those in COUNTED_ATTRIBUTES (booleans counting as 1) and errors are summed per span name in the exported
+    metrics.
+    """
+
+    __slots__ = ("tracer", "name", "attributes", "turn", "start", "duration", "_started")
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.turn = _current_turn.get()
+        self.start = None
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._started
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.tracer.record(self)
+        return False
+
+    def to_dict(self):
+        return {"name": self.name, "turn": self.turn, "start": self.start, "duration": self.duration,
+                "attributes": self.attributes}
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    """
+    Collects finished spans: keeps the latest max_spans in memory, aggregates a latency histogram and attribute
+    totals per span name, and appends every span to a JSON lines file when path is given.
+    """
+
+    def __init__(self, path=None, max_spans=MAX_SPANS, buckets=BUCKETS):
+        self.path = path
+        self.buckets = tuple(buckets)
+        self.spans = deque(maxlen=max_spans)
+        # name -> [count per bucket..., count, sum of durations]
+        self._histograms = {}
+        # (name, attribute) -> sum
+        self._totals = {}
+        self._lock = threading.Lock()
+        self._file = open(path, "a") if path else None
+
+    def record(self, span):
+        line = json.dumps(span.to_dict(), default=str) if self._file else None
+        with self._lock:
+            self.spans.append(span)
+            histogram = self._histograms.get(span.name)
+            if histogram is None:
+                histogram = self._histograms[span.name] = [0] * (len(self.buckets) + 2)
+            for position, bound in enumerate(self.buckets):
+                if span.duration <= bound:
+                    histogram[position] += 1
+            histogram[-2] += 1
+            histogram[-1] += span.duration
+            for attribute, value in span.attributes.items():
+                if attribute in COUNTED_ATTRIBUTES and isinstance(value, (bool, int, float)):
+                    key = (span.name, attribute)
+                    self._totals[key] = self._totals.get(key, 0) + value
+            if "error" in span.attributes:
+                key = (span.name, "errors")
+                self._totals[key] = self._totals.get(key, 0) + 1
+            if self._file:
+                self._file.write(line + "\n")
+                self._file.flush()
+
+    def summary(self, prefix=""):
+        """
+        Latency statistics of the spans in memory, per span name.
+
+        Returns:
+        dict: {name: {"count", "mean", "p50", "p95", "max"}} with durations in seconds.
+        """
+        with self._lock:
+            spans = list(self.spans)
+        durations = {}
+        for span in spans:
+            if span.name.startswith(prefix):
+                durations.setdefault(span.name, []).append(span.duration)
+        summary = {}
+        for name, values in sorted(durations.items()):
+            values.sort()
+            summary[name] = {"count": len(values), "mean": sum(values) / len(values),
+                             "p50": values[int(0.5 * (len(values) - 1))],
+                             "p95": values[int(0.95 * (len(values) - 1))], "max": values[-1]}
+        return summary
+
+    def write_jsonl(self, path):
+        """
+        Writes the spans in memory to path as JSON lines.
+        """
+        with self._lock:
+            spans = list(self.spans)
+        with open(path, "w") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+    def prometheus_text(self):
+        """
+        Renders the aggregated metrics in the Prometheus text exposition format.
+        """
+        lines = ["# HELP chat_span_duration_seconds Duration of traced operations.",
+                 "# TYPE chat_span_duration_seconds histogram"]
+        with self._lock:
+            histograms = {name: list(histogram) for name, histogram in self._histograms.items()}
+            totals = dict(self._totals)
+        for name, histogram in sorted(histograms.items()):
+            for bound, count in zip(self.buckets, histogram):
+                lines.append(f'chat_span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {count}')
+            lines.append(f'chat_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {histogram[-2]}')
+            lines.append(f'chat_span_duration_seconds_sum{{span="{name}"}} {histogram[-1]}')
+            lines.append(f'chat_span_duration_seconds_count{{span="{name}"}} {histogram[-2]}')
+        lines += ["# HELP chat_span_attribute_total Sum of a numeric span attribute (tokens, rows, cache hits).",
+                  "# TYPE chat_span_attribute_total counter"]
+        for (name, attribute), total in sorted(totals.items()):
+            lines.append(f'chat_span_attribute_total{{span="{name}",attribute="{attribute}"}} {total}')
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+def enable(path=None, max_spans=MAX_SPANS):
+    """
+    Turns tracing on with a fresh tracer; spans are also appended to path as JSON lines when given.
+    """
+    global _tracer
+    disable()
+    _tracer = Tracer(path, max_spans)
+    return _tracer
+
+
+def disable():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.close()
+
+
+def get_tracer():
+    """
+    Returns the active Tracer, or None when tracing is off.
+    """
+    return _tracer
+
+
+def span(name, **attributes):
+    """
+    Times the enclosed block as a span, e.g. `with span("index.query", k=20) as s: ...; s.set(rows=n)`.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NOOP_SPAN
+    return Span(tracer, name, attributes)
+
+
+def record(name, duration, **attributes):
+    """
+    Records a span that was timed elsewhere, e.g. a stream consumed by the caller, that ended just now.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return
+    span = Span(tracer, name, attributes)
+    span.start = time.time() - duration
+    span.duration = duration
+    tracer.record(span)
+
+
+@contextlib.contextmanager
+def turn(turn_id):
+    """
+    Tags the spans recorded inside the block (including stages the block runs) with a turn id.
+    """
+    token = _current_turn.set(turn_id)
+    try:
+        yield
+    finally:
+        _current_turn.reset(token)
+
+
+# CHAT_TRACE=1 traces in memory; any other value is taken as a JSON lines file to append spans to
+if os.getenv("CHAT_TRACE"):
+    enable(None if os.getenv("CHAT_TRACE") == "1" else os.getenv("CHAT_TRACE"))